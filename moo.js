@@ -12,6 +12,8 @@
   var hasOwnProperty = Object.prototype.hasOwnProperty
   var toString = Object.prototype.toString
   var hasSticky = typeof new RegExp().sticky === 'boolean'
+  var clock = typeof performance === 'object' && typeof performance.now === 'function' ? /* global performance */
+    function() { return performance.now() } : null
 
   /***************************************************************************/
 
@@ -39,6 +41,27 @@
     return "(?:" + source + ")"
   }
 
+  // Finding the capture group which matched means checking each one in turn;
+  // with lots of rules, that gets slow. So we nest the groups in blocks of
+  // about √n groups, and then we only need to check each block, and then the
+  // groups inside one block.
+  function reBlocks(parts, groups) {
+    var size = parts.length > 16 ? Math.ceil(Math.sqrt(parts.length)) : parts.length
+    if (size === parts.length) {
+      return {source: reUnion(parts), blocks: [0], captures: [null].concat(groups)}
+    }
+    var sources = []
+    var blocks = []
+    var captures = [null]
+    for (var i = 0; i < parts.length; i += size) {
+      blocks.push(captures.length)
+      captures.push(null)
+      sources.push(reCapture(reUnion(parts.slice(i, i + size))))
+      captures.push.apply(captures, groups.slice(i, i + size))
+    }
+    return {source: reUnion(sources), blocks: blocks, captures: captures}
+  }
+
   function regexpOrLiteral(obj) {
     if (typeof obj === 'string') {
       return '(?:' + reEscape(obj) + ')'
@@ -56,6 +79,72 @@
     }
   }
 
+  // Join literals into one RegExp, sharing their common prefixes, e.g.
+  // ['>>=', '>>', '>=', '>'] becomes />(?:>=?|=)?/. Trying the longer words
+  // first means we still find the longest match.
+  function reLiterals(words) {
+    if (words.length === 1) return reEscape(words[0])
+    var root = {keys: [], children: Object.create(null), accept: false}
+    for (var i = 0; i < words.length; i++) {
+      var word = words[i]
+      var node = root
+      for (var j = 0; j < word.length; j++) {
+        // keep surrogate pairs together, for /u
+        var code = word.charCodeAt(j)
+        var key = code >= 0xd800 && code <= 0xdbff && j + 1 < word.length ? word.substr(j++, 2) : word[j]
+        if (!node.children[key]) {
+          node.keys.push(key)
+          node.children[key] = {keys: [], children: Object.create(null), accept: false}
+        }
+        node = node.children[key]
+      }
+      node.accept = true
+    }
+    var escaped = Object.create(null)
+    function escape(key) {
+      return escaped[key] || (escaped[key] = reEscape(key))
+    }
+    function suffix(node) {
+      var alts = node.keys.map(function(key) {
+        return escape(key) + suffix(node.children[key])
+      })
+      if (!alts.length) return ''
+      if (!node.accept) {
+        return alts.length === 1 ? alts[0] : '(?:' + alts.join('|') + ')'
+      }
+      if (alts.length === 1 && node.keys[0].length === 1 && alts[0] === escape(node.keys[0])) {
+        return alts[0] + '?'
+      }
+      return '(?:' + alts.join('|') + ')?'
+    }
+    if (root.accept) return '(?:' + suffix(root) + ')'
+    return root.keys.map(function(key) {
+      return escape(key) + suffix(root.children[key])
+    }).join('|')
+  }
+
+  // Below this many literals, sharing prefixes costs more to compile than it
+  // saves when lexing, so we just list them.
+  var minTrieLiterals = 100
+
+  // Strings come first (see ruleOptions), so they can share one RegExp.
+  function reMatch(match) {
+    if (match.length < minTrieLiterals) {
+      return reUnion(match.map(regexpOrLiteral))
+    }
+    var words = []
+    var regexps = []
+    for (var i = 0; i < match.length; i++) {
+      if (typeof match[i] === 'string') {
+        words.push(match[i])
+      } else {
+        regexps.push(regexpOrLiteral(match[i]))
+      }
+    }
+    if (words.length) regexps.unshift(reLiterals(words))
+    return reUnion(regexps)
+  }
+
   function pad(s, length) {
     if (s.length > length) {
       return s
@@ -63,29 +152,9 @@
     return Array(length - s.length + 1).join(" ") + s
   }
 
-  function lastNLines(string, numLines) {
-    var position = string.length
-    var lineBreaks = 0;
-    while (true) {
-      var idx = string.lastIndexOf("\n", position - 1)
-      if (idx === -1) {
-        break;
-      } else {
-        lineBreaks++
-      }
-      position = idx
-      if (lineBreaks === numLines) {
-        break;
-      }
-      if (position === 0) {
-        break;
-      }
-    }
-    var startPosition = 
-      lineBreaks < numLines ?
-      0 : 
-      position + 1
-    return string.substring(startPosition).split("\n")
+  // Where the line containing `index` starts
+  function lineStart(string, index) {
+    return index > 0 ? string.lastIndexOf('\n', index - 1) + 1 : 0
   }
 
   function objectToRules(object) {
@@ -155,6 +224,7 @@
       value: null,
       type: null,
       shouldThrow: false,
+      skip: false,
     }
 
     // Avoid Object.assign(), so we support IE9+
@@ -184,18 +254,22 @@
   }
 
   var defaultErrorRule = ruleOptions('error', {lineBreaks: true, shouldThrow: true})
-  function compileRules(rules, hasStates) {
+  // With errorRecovery, we skip over the text we couldn't lex
+  var recoveredErrorRule = ruleOptions('error', {lineBreaks: true, skip: true})
+  function compileRules(rules, hasStates, dispatch) {
     var errorRule = null
-    var fast = Object.create(null)
-    var fastAllowed = true
+    var literals = []
+    var literalGroups = []
+    var conflicts = new Conflicts
     var unicodeFlag = null
+    var fallback = false
     var groups = []
     var parts = []
+    var firsts = []
 
-    // If there is a fallback rule, then disable fast matching
     for (var i = 0; i < rules.length; i++) {
       if (rules[i].fallback) {
-        fastAllowed = false
+        fallback = true
       }
     }
 
@@ -219,13 +293,31 @@
         errorRule = options
       }
 
-      var match = options.match.slice()
-      if (fastAllowed) {
-        while (match.length && typeof match[0] === 'string' && match[0].length === 1) {
-          var word = match.shift()
-          fast[word.charCodeAt(0)] = options
+      // Move literals into the fast table or trie, if no earlier rule in the
+      // RegExp could match starting with the same character. Only literal
+      // rules use the trie; other rules give up their single characters.
+      var match = options.match
+      var isLiteral = isLiteralRule(match)
+      var rest = []
+      var checked = []
+      for (var j = 0; j < match.length; j++) {
+        var word = match[j]
+        if (typeof word === 'string' && (isLiteral || word.length === 1) && !conflicts.canStart(word.charCodeAt(0))) {
+          literals.push({word: word, group: options})
+          if (word.length > 1) {
+            checked.push(word)
+          } else if (word === '\n' && !options.lineBreaks) {
+            // (longer words are checked with the RegExp, below)
+            throw new Error('Rule should declare lineBreaks: ' + new RegExp(regexpOrLiteral(word)))
+          }
+        } else {
+          rest.push(word)
+          checked.push(word)
         }
       }
+      if (rest.length < match.length) {
+        literalGroups.push(options)
+      }
 
       // Warn about inappropriate state-switching options
       if (options.pop || options.push || options.next) {
@@ -241,9 +333,6 @@
       if (match.length === 0) {
         continue
       }
-      fastAllowed = false
-
-      groups.push(options)
 
       // Check unicode flag is used everywhere or nowhere
       for (var j = 0; j < match.length; j++) {
@@ -260,26 +349,41 @@
       }
 
       // convert to RegExp
-      var pat = reUnion(match.map(regexpOrLiteral))
+      var pat = reMatch(checked)
 
       // validate
-      var regexp = new RegExp(pat)
-      if (regexp.test("")) {
-        throw new Error("RegExp matches empty string: " + regexp)
-      }
-      var groupCount = reGroups(pat)
-      if (groupCount > 0) {
-        throw new Error("RegExp has capture groups: " + regexp + "\nUse (?: … ) instead")
-      }
+      if (checked.length) {
+        var regexp = new RegExp(pat)
+        if (regexp.test("")) {
+          throw new Error("RegExp matches empty string: " + regexp)
+        }
+        var groupCount = reGroups(pat)
+        if (groupCount > 0) {
+          throw new Error("RegExp has capture groups: " + regexp + "\nUse (?: … ) instead")
+        }
 
-      // try and detect rules matching newlines
-      if (!options.lineBreaks && regexp.test('\n')) {
-        throw new Error('Rule should declare lineBreaks: ' + regexp)
+        // try and detect rules matching newlines
+        if (!options.lineBreaks && regexp.test('\n')) {
+          throw new Error('Rule should declare lineBreaks: ' + regexp)
+        }
       }
 
-      // store regex
-      parts.push(reCapture(pat))
+      // With a fallback rule, the RegExp has to find the next token anyway,
+      // so it keeps the literals too.
+      if (rest.length === 0 && !fallback) {
+        continue
+      }
+      var atoms = []
+      for (var j = 0; j < rest.length; j++) {
+        var first = conflicts.add(rest[j], unicodeFlag === true)
+        atoms = first && atoms && atoms.concat(first)
+      }
+      firsts.push(atoms)
+      groups.push(options)
+      var regexMatch = fallback ? match : rest
+      parts.push(reCapture(regexMatch.length === checked.length ? pat : reMatch(regexMatch)))
     }
+    var trie = compileLiterals(literals)
 
 
     // If there's no fallback rule, use the sticky flag so we only look for
@@ -292,13 +396,309 @@
     var suffix = hasSticky || fallbackRule ? '' : '|'
 
     if (unicodeFlag === true) flags += "u"
-    var combined = new RegExp(reUnion(parts) + suffix, flags)
-    return {regexp: combined, groups: groups, fast: fast, error: errorRule || defaultErrorRule}
+    var union = reBlocks(parts, groups)
+    var combined = new RegExp(union.source + suffix, flags)
+    union.regexp = combined
+    return {
+      regexp: combined,
+      groups: groups,
+      blocks: union.blocks,
+      captures: union.captures,
+      dispatch: dispatch && hasSticky && !fallbackRule ? compileDispatch(parts, groups, firsts, union) : null,
+      fast: trie.fast,
+      trie: trie.trie,
+      literals: literalGroups,
+      error: errorRule || defaultErrorRule,
+    }
+  }
+
+  // Work out which characters a RegExp can start matching with. Returns a
+  // list of patterns which each match one character, or null if we're not
+  // sure (e.g. because of backreferences).
+  function reFirstChars(source, unicode) {
+    var i = 0
+    var escape = unicode
+      ? /^\\(?:x[0-9a-fA-F]{2}|u\{[0-9a-fA-F]+\}|u[0-9a-fA-F]{4}|c[a-zA-Z]|[pP]\{[^}]*\}|[^])/
+      : /^\\(?:x[0-9a-fA-F]{2}|u[0-9a-fA-F]{4}|c[a-zA-Z]|[^])/
+
+    function alternation() {
+      var atoms = []
+      var nullable = false
+      do {
+        var seq = sequence()
+        if (!seq) return null
+        atoms.push.apply(atoms, seq.atoms)
+        nullable = nullable || seq.nullable
+      } while (source[i] === '|' && ++i)
+      return {atoms: atoms, nullable: nullable}
+    }
+
+    function sequence() {
+      var atoms = []
+      var nullable = true
+      while (i < source.length && source[i] !== '|' && source[i] !== ')') {
+        var term = atom()
+        if (!term) return null
+        if (quantifier() === 0) term.nullable = true
+        if (nullable) atoms.push.apply(atoms, term.atoms)
+        nullable = nullable && term.nullable
+      }
+      return {atoms: atoms, nullable: nullable}
+    }
+
+    // returns the minimum number of repeats
+    function quantifier() {
+      var c = source[i]
+      var min = 1
+      if (c === '*' || c === '?') {
+        min = 0
+        i++
+      } else if (c === '+') {
+        i++
+      } else if (c === '{') {
+        var m = /^\{(\d+)(?:,\d*)?\}/.exec(source.slice(i))
+        if (!m) return min
+        min = +m[1]
+        i += m[0].length
+      } else {
+        return min
+      }
+      if (source[i] === '?') i++ // lazy
+      return min
+    }
+
+    function atom() {
+      var c = source[i]
+      var start = i
+      switch (c) {
+        case '(':
+          var lookaround = false
+          i++
+          if (source[i] === '?') {
+            var m = /^\?(?::|(<?)[=!]|<[^>]*>)/.exec(source.slice(i))
+            if (!m) return null
+            lookaround = m[1] != null
+            i += m[0].length
+          }
+          var inner = alternation()
+          if (!inner || source[i] !== ')') return null
+          i++
+          // lookarounds only narrow what can match, so we can ignore them
+          return lookaround ? {atoms: [], nullable: true} : inner
+        case '[':
+          i++
+          if (source[i] === '^') i++
+          while (i < source.length && source[i] !== ']') {
+            if (source[i] === '\\') i++
+            i++
+          }
+          if (i >= source.length) return null
+          i++
+          return {atoms: [source.slice(start, i)], nullable: false}
+        case '\\':
+          var d = source[i + 1]
+          if (d === 'b' || d === 'B') {
+            i += 2
+            return {atoms: [], nullable: true}
+          }
+          // backreferences and legacy octal escapes
+          if (/[1-9k]/.test(d) || d === '0' && /[0-9]/.test(source[i + 2])) return null
+          if (d === 'c' && !/[a-zA-Z]/.test(source[i + 2])) return null
+          var m = escape.exec(source.slice(i))
+          if (!m) return null
+          i += m[0].length
+          return {atoms: [m[0]], nullable: false}
+        case '^':
+        case '$':
+          i++
+          return {atoms: [], nullable: true}
+        case '*':
+        case '+':
+        case '?':
+          return null
+        case '.':
+          i++
+          return {atoms: ['.'], nullable: false}
+        default:
+          i++
+          return {atoms: [reEscape(c)], nullable: false}
+      }
+    }
+
+    var result = alternation()
+    if (!result || result.nullable || i !== source.length) return null
+    return result.atoms
   }
 
-  function compile(rules) {
-    var result = compileRules(toRules(rules))
-    return new Lexer({start: result}, 'start')
+  // Keeps track of which characters the rules in the RegExp could start
+  // with, so we know which literals are safe to match before running it.
+  function Conflicts() {
+    this.chars = Object.create(null)
+    this.atoms = []
+    this.unicode = false
+    this.any = false
+    this.tester = null
+    this.tested = Object.create(null)
+  }
+
+  // Returns the patterns for the characters obj can start with, or null.
+  Conflicts.prototype.add = function(obj, unicode) {
+    if (typeof obj === 'string') {
+      this.chars[obj.charCodeAt(0)] = true
+      return [reEscape(obj.charAt(0))]
+    }
+    var atoms = reFirstChars(obj.source, unicode)
+    if (!atoms) {
+      this.any = true
+      return null
+    }
+    this.atoms.push.apply(this.atoms, atoms)
+    this.unicode = unicode
+    this.tester = null
+    this.tested = Object.create(null)
+    return atoms
+  }
+
+  Conflicts.prototype.canStart = function(code) {
+    if (this.any || this.chars[code]) return true
+    if (!this.atoms.length) return false
+    // surrogates might be half of a character in a /u RegExp
+    if (code >= 0xd800 && code <= 0xdfff) return true
+    var tested = this.tested[code]
+    if (tested !== undefined) return tested
+    if (!this.tester) {
+      this.tester = new RegExp('^(?:' + this.atoms.join('|') + ')$', this.unicode ? 'u' : '')
+    }
+    return this.tested[code] = this.tester.test(String.fromCharCode(code))
+  }
+
+  // Build a smaller RegExp for each ASCII character, containing only the
+  // rules which could start with it. Other characters use the full RegExp.
+  function compileDispatch(parts, groups, firsts, full) {
+    var flags = full.regexp.flags
+    var testers = firsts.map(function(atoms) {
+      return atoms && new RegExp('^(?:' + atoms.join('|') + ')$', full.regexp.unicode ? 'u' : '')
+    })
+    var table = []
+    var byKey = Object.create(null)
+    for (var code = 0; code < 128; code++) {
+      var c = String.fromCharCode(code)
+      var subParts = []
+      var subGroups = []
+      var key = ''
+      for (var i = 0; i < parts.length; i++) {
+        if (testers[i] && !testers[i].test(c)) continue
+        subParts.push(parts[i])
+        subGroups.push(groups[i])
+        key += i + ','
+      }
+      if (subParts.length === parts.length) {
+        table.push(full)
+        continue
+      }
+      if (!byKey[key]) {
+        var union = reBlocks(subParts, subGroups)
+        union.regexp = new RegExp(union.source, flags)
+        byKey[key] = union
+      }
+      table.push(byKey[key])
+    }
+    return table
+  }
+
+  function isLiteralRule(match) {
+    for (var i = 0; i < match.length; i++) {
+      if (typeof match[i] !== 'string' || match[i] === '') return false
+    }
+    return match.length > 0
+  }
+
+  // Literals that can be matched without running the RegExp, keyed by their
+  // first character code. If the best match for a character is that character
+  // alone, it goes in the `fast` table; otherwise we walk a trie. Each trie
+  // node stores the best literal ending at or above it, so the deepest node we
+  // reach has the answer.
+  function compileLiterals(literals) {
+    var fast = Object.create(null)
+    var trie = Object.create(null)
+    for (var i = 0; i < literals.length; i++) {
+      var word = literals[i].word
+      var code = word.charCodeAt(0)
+      if (fast[code]) continue
+      if (word.length === 1 && !trie[code]) {
+        fast[code] = literals[i].group
+        continue
+      }
+      var node = trie[code] || (trie[code] = {next: Object.create(null), group: null, length: 0})
+      for (var j = 1; j < word.length; j++) {
+        var c = word.charCodeAt(j)
+        node = node.next[c] || (node.next[c] = {next: Object.create(null), group: null, length: 0})
+      }
+      // earlier rules (and longer words) win
+      if (!node.group) {
+        node.group = literals[i].group
+        node.length = word.length
+        node.rank = i
+      }
+    }
+    function inherit(node, best) {
+      if (best && (!node.group || best.rank < node.rank)) {
+        node.group = best.group
+        node.length = best.length
+        node.rank = best.rank
+      }
+      best = node.group ? node : null
+      for (var c in node.next) inherit(node.next[c], best)
+    }
+    for (var code in trie) inherit(trie[code], null)
+    return {fast: fast, trie: trie}
+  }
+
+  function lexerOptions(obj) {
+    var options = {
+      lazyText: false,
+      dispatch: false,
+      cache: false,
+      codegen: false,
+      positionTracking: 'full',
+      reuseTokens: false,
+      errorRecovery: false,
+      profile: false,
+    }
+    for (var key in obj) {
+      if (hasOwnProperty.call(obj, key)) {
+        if (!hasOwnProperty.call(options, key)) {
+          throw new Error("Unknown lexer option '" + key + "'")
+        }
+        options[key] = obj[key]
+      }
+    }
+    var tracking = options.positionTracking
+    if (tracking !== 'full' && tracking !== 'offset' && tracking !== 'none') {
+      throw new Error("positionTracking must be 'full', 'offset' or 'none' (not '" + tracking + "')")
+    }
+    if (options.reuseTokens && options.lazyText) {
+      throw new Error("reuseTokens can't be used with lazyText")
+    }
+    var recovery = options.errorRecovery
+    if (recovery !== false && recovery !== 'char' && recovery !== 'resync') {
+      throw new Error("errorRecovery must be false, 'char' or 'resync' (not '" + recovery + "')")
+    }
+    return options
+  }
+
+  function compile(rules, options) {
+    options = lexerOptions(options)
+    if (options.cache) {
+      return lexerCache.lookup(['compile', rules, options], build)
+    }
+    return build()
+
+    function build() {
+      var result = compileRules(toRules(rules), false, options.dispatch)
+      var map = {start: result}
+      return new Lexer(map, 'start', compileTypes(map), options)
+    }
   }
 
   function checkStateGroup(g, name, map) {
@@ -310,7 +710,21 @@
       throw new Error("pop must be 1 (in token '" + g.defaultType + "' of state '" + name + "')")
     }
   }
-  function compileStates(states, start) {
+  function compileStates(states, start, options) {
+    if (isObject(start)) {
+      options = start
+      start = null
+    }
+    options = lexerOptions(options)
+    if (options.cache) {
+      return lexerCache.lookup(['states', states, start, options], function() {
+        return buildStates(states, start, options)
+      })
+    }
+    return buildStates(states, start, options)
+  }
+
+  function buildStates(states, start, options) {
     var all = states.$all ? toRules(states.$all) : []
     delete states.$all
 
@@ -350,7 +764,7 @@
     var map = Object.create(null)
     for (var i = 0; i < keys.length; i++) {
       var key = keys[i]
-      map[key] = compileRules(ruleMap[key], true)
+      map[key] = compileRules(ruleMap[key], true, options.dispatch)
     }
 
     for (var i = 0; i < keys.length; i++) {
@@ -360,13 +774,53 @@
       for (var j = 0; j < groups.length; j++) {
         checkStateGroup(groups[j], name, map)
       }
-      var fastKeys = Object.getOwnPropertyNames(state.fast)
-      for (var j = 0; j < fastKeys.length; j++) {
-        checkStateGroup(state.fast[fastKeys[j]], name, map)
+      for (var j = 0; j < state.literals.length; j++) {
+        checkStateGroup(state.literals[j], name, map)
+      }
+    }
+
+    return new Lexer(map, start, compileTypes(map), options)
+  }
+
+  // Assign a dense integer id to every token type the lexer can produce.
+  function compileTypes(map) {
+    var types = {names: [], ids: Object.create(null), dynamic: false}
+    function add(type) {
+      if (types.ids[type] === undefined) {
+        types.ids[type] = types.names.length
+        types.names.push(type)
+      }
+      return types.ids[type]
+    }
+    function addGroup(group) {
+      group.typeId = add(group.defaultType)
+      var transform = group.type
+      if (typeof transform !== 'function') return
+      if (transform.keywords) {
+        var keywordTypes = Object.getOwnPropertyNames(transform.keywords)
+        for (var i = 0; i < keywordTypes.length; i++) {
+          add(keywordTypes[i])
+        }
+      } else {
+        // we can't know what an arbitrary function will return
+        types.dynamic = true
       }
     }
 
-    return new Lexer(map, start)
+    var keys = Object.getOwnPropertyNames(map)
+    for (var i = 0; i < keys.length; i++) {
+      var state = map[keys[i]]
+      for (var j = 0; j < state.groups.length; j++) {
+        addGroup(state.groups[j])
+      }
+      for (var j = 0; j < state.literals.length; j++) {
+        addGroup(state.literals[j])
+      }
+      if (state.error !== defaultErrorRule) {
+        addGroup(state.error)
+      }
+    }
+    return types
   }
 
   function keywordTransform(map) {
@@ -376,11 +830,13 @@
     var isMap = typeof Map !== 'undefined'
     var reverseMap = isMap ? new Map : Object.create(null)
 
+    var keywords = Object.create(null)
     var types = Object.getOwnPropertyNames(map)
     for (var i = 0; i < types.length; i++) {
       var tokenType = types[i]
       var item = map[tokenType]
       var keywordList = Array.isArray(item) ? item : [item]
+      keywords[tokenType] = keywordList
       keywordList.forEach(function(keyword) {
         if (typeof keyword !== 'string') {
           throw new Error("keyword must be string (in keyword '" + tokenType + "')")
@@ -392,44 +848,427 @@
         }
       })
     }
-    return function(k) {
+    var transform = function(k) {
       return isMap ? reverseMap.get(k) : reverseMap[k]
     }
+    // Remember the keywords, so the lexer knows which types it can produce
+    transform.keywords = keywords
+    return transform
+  }
+
+  /***************************************************************************/
+
+  // Describe a grammar spec as a string, so we can tell when we've seen it
+  // before. Returns null if we can't.
+  var functionIds = typeof WeakMap !== 'undefined' ? new WeakMap : null
+  var nextFunctionId = 0
+  function fingerprint(obj) {
+    if (isRegExp(obj)) {
+      return String(obj)
+    } else if (typeof obj === 'string') {
+      return JSON.stringify(obj)
+    } else if (typeof obj === 'function') {
+      // keyword transforms are the same if their keywords are
+      if (obj.keywords) {
+        return 'keywords' + fingerprint(obj.keywords)
+      }
+      if (!functionIds) return null
+      var id = functionIds.get(obj)
+      if (id === undefined) {
+        functionIds.set(obj, id = nextFunctionId++)
+      }
+      return 'function#' + id
+    } else if (Array.isArray(obj)) {
+      var items = []
+      for (var i = 0; i < obj.length; i++) {
+        var item = fingerprint(obj[i])
+        if (item === null) return null
+        items.push(item)
+      }
+      return '[' + items.join(',') + ']'
+    } else if (obj && typeof obj === 'object') {
+      var keys = Object.getOwnPropertyNames(obj)
+      var items = []
+      for (var i = 0; i < keys.length; i++) {
+        var item = fingerprint(obj[keys[i]])
+        if (item === null) return null
+        items.push(JSON.stringify(keys[i]) + ':' + item)
+      }
+      return '{' + items.join(',') + '}'
+    }
+    return String(obj)
+  }
+
+  // A least-recently-used cache of compiled lexers, for the `cache` option.
+  // `size` is the total length of the fingerprints, as a rough measure of
+  // how much memory the grammars take up.
+  function LexerCache() {
+    this.maxEntries = 100
+    this.maxSize = 1 << 24
+    this.clear()
+  }
+
+  LexerCache.prototype.clear = function() {
+    this.map = Object.create(null)
+    // a circular list, most recently used first
+    this.head = {}
+    this.head.next = this.head.prev = this.head
+    this.entries = 0
+    this.size = 0
+    this.hits = 0
+    this.misses = 0
+    this.evictions = 0
+  }
+
+  LexerCache.prototype.lookup = function(spec, build) {
+    var key = fingerprint(spec)
+    var entry = key !== null ? this.map[key] : null
+    if (entry) {
+      this.hits++
+      this._unlink(entry)
+      this._link(entry)
+      return entry.lexer.clone()
+    }
+    this.misses++
+    var lexer = build()
+    if (key === null || key.length > this.maxSize) {
+      return lexer
+    }
+    entry = {key: key, lexer: lexer, next: null, prev: null}
+    this.map[key] = entry
+    this._link(entry)
+    this.entries++
+    this.size += key.length
+    while (this.entries > this.maxEntries || this.size > this.maxSize) {
+      var last = this.head.prev
+      this._unlink(last)
+      delete this.map[last.key]
+      this.entries--
+      this.size -= last.key.length
+      this.evictions++
+    }
+    return lexer.clone()
+  }
+
+  LexerCache.prototype._link = function(entry) {
+    var head = this.head
+    entry.next = head.next
+    entry.prev = head
+    head.next.prev = entry
+    head.next = entry
+  }
+
+  LexerCache.prototype._unlink = function(entry) {
+    entry.prev.next = entry.next
+    entry.next.prev = entry.prev
+  }
+
+  var lexerCache = new LexerCache
+
+  /***************************************************************************/
+
+  // Save a compiled lexer as JSON, so it can be loaded again without
+  // compiling it. Functions are saved by name: either their key in
+  // `functions`, or their own name.
+  function serialize(lexer, functions) {
+    var groups = []
+    var named = Object.create(null)
+    function groupIndex(group) {
+      if (!group) return null
+      if (group === defaultErrorRule) return -1
+      var index = groups.indexOf(group)
+      return index !== -1 ? index : groups.push(group) - 1
+    }
+
+    // `path` is where we found the value, like 'string.value'
+    function encode(value, path) {
+      if (isRegExp(value)) {
+        return {$regexp: value.source, flags: reFlags(value)}
+      } else if (typeof value === 'function') {
+        if (value.keywords) {
+          return {$keywords: value.keywords}
+        }
+        for (var key in functions) {
+          if (functions[key] === value) return {$function: key}
+        }
+        var name = value.name
+        if (path && (!name || name === 'value' || name === 'type')) {
+          // inline functions are named after the property they're in, which
+          // doesn't tell them apart; so name them after their rule instead
+          name = path
+          for (var n = 2; named[name] && named[name] !== value; n++) name = path + n
+        }
+        if (!name) {
+          throw new Error('Cannot serialize anonymous function: ' + value)
+        }
+        if (named[name] && named[name] !== value) {
+          throw new Error("Cannot tell apart functions named '" + name + "' (pass them to serialize() by name)")
+        }
+        named[name] = value
+        return {$function: name}
+      } else if (Array.isArray(value)) {
+        return value.map(function(item) { return encode(item) })
+      } else if (value && typeof value === 'object') {
+        var obj = {}
+        for (var key in value) {
+          if (hasOwnProperty.call(value, key)) {
+            obj[key] = encode(value[key], value.defaultType !== undefined ? value.defaultType + '.' + key : undefined)
+          }
+        }
+        return obj
+      }
+      return value
+    }
+
+    function encodeUnion(union) {
+      return {
+        source: union.regexp.source,
+        flags: reFlags(union.regexp),
+        blocks: union.blocks,
+        captures: union.captures.map(groupIndex),
+      }
+    }
+
+    function encodeTrie(node) {
+      var next = {}
+      for (var code in node.next) next[code] = encodeTrie(node.next[code])
+      return {next: next, group: groupIndex(node.group), length: node.length, rank: node.rank}
+    }
+
+    var states = {}
+    var keys = Object.getOwnPropertyNames(lexer.states)
+    for (var i = 0; i < keys.length; i++) {
+      var info = lexer.states[keys[i]]
+      var fast = {}
+      for (var code in info.fast) fast[code] = groupIndex(info.fast[code])
+      var trie = {}
+      for (var code in info.trie) trie[code] = encodeTrie(info.trie[code])
+      var dispatch = null
+      if (info.dispatch) {
+        var unions = []
+        dispatch = {unions: unions, table: info.dispatch.map(function(union) {
+          var index = unions.indexOf(union)
+          return index !== -1 ? index : unions.push(union) - 1
+        })}
+        dispatch.unions = unions.map(encodeUnion)
+      }
+      states[keys[i]] = {
+        regexp: encodeUnion({regexp: info.regexp, blocks: info.blocks, captures: info.captures}),
+        groups: info.groups.map(groupIndex),
+        fast: fast,
+        trie: trie,
+        literals: info.literals.map(groupIndex),
+        dispatch: dispatch,
+        error: groupIndex(info.error),
+      }
+    }
+
+    return JSON.stringify({
+      moo: 1,
+      start: lexer.startState,
+      options: lexer.options,
+      types: {names: lexer.types.names, dynamic: lexer.types.dynamic},
+      groups: groups.map(function(group) { return encode(group) }),
+      states: states,
+    })
+  }
+
+  function deserialize(json, functions) {
+    var data = typeof json === 'string' ? JSON.parse(json) : json
+    if (data.moo !== 1) {
+      throw new Error('Not a serialized lexer')
+    }
+
+    function decode(value) {
+      if (Array.isArray(value)) {
+        return value.map(decode)
+      } else if (value && typeof value === 'object') {
+        if (value.$regexp !== undefined) {
+          return new RegExp(value.$regexp, value.flags)
+        } else if (value.$keywords) {
+          return keywordTransform(value.$keywords)
+        } else if (value.$function) {
+          var fn = functions && functions[value.$function]
+          if (typeof fn !== 'function') {
+            throw new Error("Missing function '" + value.$function + "'")
+          }
+          return fn
+        }
+        var obj = {}
+        for (var key in value) {
+          if (hasOwnProperty.call(value, key)) obj[key] = decode(value[key])
+        }
+        return obj
+      }
+      return value
+    }
+
+    var groups = data.groups.map(decode)
+    function group(index) {
+      return index === null ? null : index === -1 ? defaultErrorRule : groups[index]
+    }
+
+    function decodeUnion(union) {
+      if (union.flags.indexOf('y') !== -1 && !hasSticky) {
+        throw new Error('Serialized lexer needs sticky RegExps')
+      }
+      return {
+        regexp: new RegExp(union.source, union.flags),
+        blocks: union.blocks,
+        captures: union.captures.map(group),
+      }
+    }
+
+    function decodeTrie(node) {
+      var next = Object.create(null)
+      for (var code in node.next) next[code] = decodeTrie(node.next[code])
+      return {next: next, group: group(node.group), length: node.length, rank: node.rank}
+    }
+
+    var map = Object.create(null)
+    var keys = Object.getOwnPropertyNames(data.states)
+    for (var i = 0; i < keys.length; i++) {
+      var state = data.states[keys[i]]
+      var union = decodeUnion(state.regexp)
+      var fast = Object.create(null)
+      for (var code in state.fast) fast[code] = group(state.fast[code])
+      var trie = Object.create(null)
+      for (var code in state.trie) trie[code] = decodeTrie(state.trie[code])
+      var dispatch = null
+      if (state.dispatch) {
+        var unions = state.dispatch.unions.map(decodeUnion)
+        dispatch = state.dispatch.table.map(function(index) { return unions[index] })
+      }
+      map[keys[i]] = {
+        regexp: union.regexp,
+        groups: state.groups.map(group),
+        blocks: union.blocks,
+        captures: union.captures,
+        dispatch: dispatch,
+        fast: fast,
+        trie: trie,
+        literals: state.literals.map(group),
+        error: group(state.error),
+      }
+    }
+
+    var types = {names: data.types.names.slice(), ids: Object.create(null), dynamic: data.types.dynamic}
+    for (var i = 0; i < types.names.length; i++) {
+      types.ids[types.names[i]] = i
+    }
+    return new Lexer(map, data.start, types, lexerOptions(data.options))
+  }
+
+  function reFlags(re) {
+    return (re.global ? 'g' : '') + (re.ignoreCase ? 'i' : '') + (re.multiline ? 'm' : '') + (re.dotAll ? 's' : '') +
+      (re.unicode ? 'u' : '') + (re.sticky ? 'y' : '')
   }
 
   /***************************************************************************/
 
-  var Lexer = function(states, state) {
+  var Lexer = function(states, state, types, options) {
     this.startState = state
     this.states = states
+    this.types = types
+    this.options = options
+    if (options.lazyText) {
+      this._token = this._lazyToken
+    } else if (options.codegen && !options.profile) {
+      generateStates(states, options)
+    }
+    if (options.reuseTokens) {
+      this.token = new Token
+      this._token = this._reusedToken
+    }
+    if (options.positionTracking !== 'full') {
+      this._advance = this._advanceIndex
+      if (options.positionTracking === 'none' && !options.lazyText) {
+        this.next = this._nextWithoutOffset
+      }
+    }
+    if (options.profile) {
+      this._match = this._profiledMatch
+      this.counters = Object.create(null)
+    }
     this.buffer = ''
-    this.stack = []
+    this.stack = emptyStack
+    this.peeked = []
+    this.peekedInfo = []
     this.reset()
   }
 
   Lexer.prototype.reset = function(data, info) {
     this.buffer = data || ''
+    this.base = 0
     this.index = 0
-    this.line = info ? info.line : 1
-    this.col = info ? info.col : 1
-    this.queuedToken = info ? info.queuedToken : null
+    var full = this.options.positionTracking === 'full'
+    this.line = info ? info.line : full ? 1 : undefined
+    this.col = info ? info.col : full ? 1 : undefined
+    this.queuedGroup = info ? info.queuedGroup : null
     this.queuedText = info ? info.queuedText: "";
-    this.queuedThrow = info ? info.queuedThrow : null
     this.setState(info ? info.state : this.startState)
-    this.stack = info && info.stack ? info.stack.slice() : []
+    this.stack = info && info.stack ? toStack(info.stack) : emptyStack
+    this.firstLine = info && info.line !== undefined ? info.line : 1
+    // (if we didn't start at col 1, pretend the first line started earlier)
+    this.firstStart = 1 - (info && info.col !== undefined ? info.col : 1)
+    this.lineStarts = null
+    this.lineScan = 0
+    this.errors = []
+    if (this.peekCount) {
+      this.peeked = []
+      this.peekedInfo = []
+    }
+    this.peekHead = 0
+    this.peekCount = 0
     return this
   }
 
   Lexer.prototype.save = function() {
+    if (this.peekCount) {
+      // we've lexed further than the caller has seen
+      var info = this.peekedInfo[this.peekHead]
+      return {
+        line: info.line,
+        col: info.col,
+        state: info.state,
+        stack: info.stack,
+        queuedGroup: info.queuedGroup,
+        queuedText: info.queuedText,
+        offset: info.offset,
+      }
+    }
     return {
       line: this.line,
       col: this.col,
       state: this.state,
-      stack: this.stack.slice(),
-      queuedToken: this.queuedToken,
+      stack: this.stack,
+      queuedGroup: this.queuedGroup,
       queuedText: this.queuedText,
-      queuedThrow: this.queuedThrow,
+      offset: this.base + this.index,
+    }
+  }
+
+  // Go back to a point we saved earlier, without touching the buffer.
+  Lexer.prototype.restore = function(info) {
+    var index = info.offset - this.base
+    if (!(index >= 0 && index <= this.buffer.length)) {
+      throw new Error("Can't restore offset " + info.offset + ": it's not in the buffer")
+    }
+    this.index = index
+    this.line = info.line
+    this.col = info.col
+    this.queuedGroup = info.queuedGroup
+    this.queuedText = info.queuedText
+    this.setState(info.state)
+    this.stack = toStack(info.stack)
+    this._forgetErrors()
+    if (this.peekCount) {
+      this.peeked = []
+      this.peekedInfo = []
     }
+    this.peekHead = 0
+    this.peekCount = 0
+    return this
   }
 
   Lexer.prototype.setState = function(state) {
@@ -437,20 +1276,65 @@
     this.state = state
     var info = this.states[state]
     this.groups = info.groups
+    this.blocks = info.blocks
+    this.captures = info.captures
     this.error = info.error
     this.re = info.regexp
     this.fast = info.fast
+    this.trie = info.trie
+    this.dispatch = info.dispatch
+    if (info.next) this.next = info.next
   }
 
   Lexer.prototype.popState = function() {
-    this.setState(this.stack.pop())
+    var stack = this.stack
+    if (!stack.length) return
+    this.stack = stack.below
+    this.setState(stack.state)
   }
 
   Lexer.prototype.pushState = function(state) {
-    this.stack.push(this.state)
+    this.stack = new StateStack(this.state, this.stack)
     this.setState(state)
   }
 
+  // The state stack is a linked list which we never modify, so save() can
+  // hand it out without copying it.
+  var StateStack = function(state, below) {
+    this.state = state
+    this.below = below
+    this.length = below ? below.length + 1 : 0
+  }
+
+  // bottom first, like the arrays reset() accepts
+  StateStack.prototype.toArray = function() {
+    var states = new Array(this.length)
+    for (var s = this; s.length; s = s.below) {
+      states[s.length - 1] = s.state
+    }
+    return states
+  }
+
+  StateStack.prototype.toJSON = StateStack.prototype.toArray
+
+  var emptyStack = new StateStack(undefined, null)
+
+  function toStack(stack) {
+    if (stack instanceof StateStack) return stack
+    var result = emptyStack
+    for (var i = 0; i < stack.length; i++) {
+      result = new StateStack(stack[i], result)
+    }
+    return result
+  }
+
+  function sameStack(a, b) {
+    for (; a !== b; a = a.below, b = b.below) {
+      if (a.length !== b.length || a.state !== b.state) return false
+    }
+    return true
+  }
+
   var eat = hasSticky ? function(re, buffer) { // assume re is /y
     return re.exec(buffer)
   } : function(re, buffer) { // assume re is /g
@@ -462,11 +1346,15 @@
     return match
   }
 
-  Lexer.prototype._getGroup = function(match) {
-    var groupCount = this.groups.length
-    for (var i = 0; i < groupCount; i++) {
-      if (match[i + 1] !== undefined) {
-        return this.groups[i]
+  Lexer.prototype._getGroup = function(match, blocks, captures) {
+    for (var i = 0; i < blocks.length; i++) {
+      var start = blocks[i]
+      if (match[start] !== undefined) {
+        for (var j = start + 1; j < match.length; j++) {
+          if (match[j] !== undefined) {
+            return captures[j]
+          }
+        }
       }
     }
     throw new Error('Cannot find token type for matched text')
@@ -477,14 +1365,28 @@
   }
 
   Lexer.prototype.next = function() {
+    if (this.peekCount) return this._unpeek()
+    var group
+    while (group = this._match()) {
+      if (!group.skip) {
+        return this._token(group, this.matchText, this.base + this.index)
+      }
+      this._advance(group, this.matchText)
+    }
+  }
+
+  // Find the rule matching at the current index, without consuming it.
+  // Returns the rule's options, and leaves the matched text in `matchText`.
+  Lexer.prototype._match = function() {
     var index = this.index
 
     // If a fallback token matched, we don't need to re-run the RegExp
     if (this.queuedGroup) {
-      var token = this._token(this.queuedGroup, this.queuedText, index)
+      var group = this.queuedGroup
+      this.matchText = this.queuedText
       this.queuedGroup = null
       this.queuedText = ""
-      return token
+      return group
     }
 
     var buffer = this.buffer
@@ -495,21 +1397,49 @@
     // Fast matching for single characters
     var group = this.fast[buffer.charCodeAt(index)]
     if (group) {
-      return this._token(group, buffer.charAt(index), index)
+      this.matchText = buffer.charAt(index)
+      return group
+    }
+
+    // Walk the trie for longer literals
+    var node = this.trie[buffer.charCodeAt(index)]
+    if (node) {
+      var end = index + 1
+      var next
+      while ((next = node.next[buffer.charCodeAt(end)])) {
+        node = next
+        end++
+      }
+      if (node.group) {
+        this.matchText = buffer.substr(index, node.length)
+        return node.group
+      }
     }
 
-    // Execute RegExp
+    // Execute RegExp, or the smaller one for this character
     var re = this.re
+    var blocks = this.blocks
+    var captures = this.captures
+    var sub = this.dispatch && this.dispatch[buffer.charCodeAt(index)]
+    if (sub) {
+      re = sub.regexp
+      blocks = sub.blocks
+      captures = sub.captures
+    }
     re.lastIndex = index
     var match = eat(re, buffer)
 
     // Error tokens match the remaining buffer
     var error = this.error
     if (match == null) {
-      return this._token(error, buffer.slice(index, buffer.length), index)
+      if (this.options.errorRecovery && !error.fallback) {
+        return this._recover(index)
+      }
+      this.matchText = buffer.slice(index, buffer.length)
+      return error
     }
 
-    var group = this._getGroup(match)
+    var group = this._getGroup(match, blocks, captures)
     var text = match[0]
 
     if (error.fallback && match.index !== index) {
@@ -517,59 +1447,1536 @@
       this.queuedText = text
 
       // Fallback tokens contain the unmatched portion of the buffer
-      return this._token(error, buffer.slice(index, match.index), index)
+      this.matchText = buffer.slice(index, match.index)
+      return error
     }
 
-    return this._token(group, text, index)
+    this.matchText = text
+    return group
   }
 
-  Lexer.prototype._token = function(group, text, offset) {
-    // count line breaks
-    var lineBreaks = 0
-    if (group.lineBreaks) {
-      var matchNL = /\n/g
-      var nl = 1
-      if (text === '\n') {
-        lineBreaks = 1
-      } else {
-        while (matchNL.exec(text)) { lineBreaks++; nl = matchNL.lastIndex }
+  // Note the error, and skip either one character or everything up to where
+  // some rule matches again.
+  Lexer.prototype._recover = function(index) {
+    var buffer = this.buffer
+    var end = index + charLength(buffer, index)
+    if (this.options.errorRecovery === 'resync') {
+      while (end < buffer.length && !this._matchesAt(end)) {
+        end += charLength(buffer, end)
       }
     }
-
-    var token = {
-      type: (typeof group.type === 'function' && group.type(text)) || group.defaultType,
-      value: typeof group.value === 'function' ? group.value(text) : text,
+    var text = buffer.slice(index, end)
+    this.errors.push({
       text: text,
-      toString: tokenToString,
-      offset: offset,
-      lineBreaks: lineBreaks,
+      offset: this.base + index,
       line: this.line,
       col: this.col,
+    })
+    this.matchText = text
+    return recoveredErrorRule
+  }
+
+  // Don't split surrogate pairs
+  function charLength(buffer, index) {
+    var code = buffer.charCodeAt(index)
+    if (code >= 0xd800 && code <= 0xdbff) {
+      var low = buffer.charCodeAt(index + 1)
+      if (low >= 0xdc00 && low <= 0xdfff) return 2
+    }
+    return 1
+  }
+
+  Lexer.prototype._matchesAt = function(index) {
+    if (this._literalAt(index)) return true
+    var buffer = this.buffer
+    var re = this.re
+    re.lastIndex = index
+    return eat(re, buffer) != null
+  }
+
+  // Which of the literal tables has a match at `index`: 'fast', 'trie', or
+  // null if only the RegExp could match.
+  Lexer.prototype._literalAt = function(index) {
+    var buffer = this.buffer
+    var code = buffer.charCodeAt(index)
+    if (this.fast[code]) return 'fast'
+    var node = this.trie[code]
+    if (node) {
+      var next
+      var end = index + 1
+      while ((next = node.next[buffer.charCodeAt(end)])) {
+        node = next
+        end++
+      }
+      if (node.group) return 'trie'
+    }
+    return null
+  }
+
+  // With the profile option, _match() counts what it does. We time one in
+  // every 64 RegExp matches, if there's a clock.
+  Lexer.prototype._profiledMatch = function() {
+    var counters = this.counters[this.state] || (this.counters[this.state] = new StateCounters)
+    var via = this.queuedGroup ? 'regex' : this._literalAt(this.index) || 'regex'
+    var timed = via === 'regex' && clock && counters.regex % 64 === 0
+    var start = timed ? clock() : 0
+    var group = Lexer.prototype._match.call(this)
+    if (!group) return group
+    if (timed) {
+      counters.timed++
+      counters.time += clock() - start
+    }
+
+    var size = this.matchText.length
+    counters.tokens++
+    counters.chars += size
+    counters[via]++
+    if (group.pop) counters.pops++
+    else if (group.push) counters.pushes++
+    else if (group.next) counters.nexts++
+    var type = group.defaultType
+    var rule = counters.rules[type] || (counters.rules[type] = new RuleCounters)
+    rule.tokens++
+    rule.chars += size
+    rule[via]++
+    return group
+  }
+
+  var RuleCounters = function() {
+    this.tokens = 0
+    this.chars = 0
+    this.fast = 0
+    this.trie = 0
+    this.regex = 0
+  }
+
+  var StateCounters = function() {
+    RuleCounters.call(this)
+    this.pushes = 0
+    this.pops = 0
+    this.nexts = 0
+    this.timed = 0
+    this.time = 0
+    this.rules = Object.create(null)
+  }
+
+  // What the profile option counted, for each state and rule, since the lexer
+  // was made. `regexTime` is an estimate, in milliseconds.
+  Lexer.prototype.stats = function() {
+    if (!this.counters) {
+      throw new Error("stats() needs the profile option")
+    }
+    var states = {}
+    for (var name in this.counters) {
+      var counters = this.counters[name]
+      var rules = {}
+      for (var type in counters.rules) {
+        var rule = counters.rules[type]
+        rules[type] = {
+          tokens: rule.tokens,
+          chars: rule.chars,
+          fast: rule.fast,
+          trie: rule.trie,
+          regex: rule.regex,
+        }
+      }
+      states[name] = {
+        tokens: counters.tokens,
+        chars: counters.chars,
+        fast: counters.fast,
+        trie: counters.trie,
+        regex: counters.regex,
+        regexTime: counters.timed ? counters.time / counters.timed * counters.regex : 0,
+        pushes: counters.pushes,
+        pops: counters.pops,
+        nexts: counters.nexts,
+        rules: rules,
+      }
+    }
+    return {states: states}
+  }
+
+  // Drop the errors we found after the current index, since we'll lex that
+  // part again.
+  Lexer.prototype._forgetErrors = function() {
+    var errors = this.errors
+    var offset = this.base + this.index
+    while (errors.length && errors[errors.length - 1].offset >= offset) {
+      errors.pop()
+    }
+  }
+
+  // Consume the matched text: update the position, and switch states.
+  // Returns the number of line breaks in the text.
+  Lexer.prototype._advance = function(group, text) {
+    // count line breaks
+    var lineBreaks = 0
+    var last = -1
+    if (group.lineBreaks) {
+      var nl = text.indexOf('\n')
+      while (nl !== -1) {
+        lineBreaks++
+        last = nl
+        nl = text.indexOf('\n', nl + 1)
+      }
     }
-    // nb. adding more props to token object will make V8 sad!
 
     var size = text.length
     this.index += size
     this.line += lineBreaks
     if (lineBreaks !== 0) {
-      this.col = size - nl + 1
+      this.col = size - last
     } else {
       this.col += size
     }
 
+    if (group.pop) this.popState()
+    else if (group.push) this.pushState(group.push)
+    else if (group.next) this.setState(group.next)
+
+    return lineBreaks
+  }
+
+  // With positionTracking 'offset' or 'none', we don't count lines at all.
+  Lexer.prototype._advanceIndex = function(group, text) {
+    this.index += text.length
+
+    if (group.pop) this.popState()
+    else if (group.push) this.pushState(group.push)
+    else if (group.next) this.setState(group.next)
+  }
+
+  Lexer.prototype._nextWithoutOffset = function() {
+    if (this.peekCount) return this._unpeek()
+    var group
+    while (group = this._match()) {
+      if (!group.skip) {
+        return this._token(group, this.matchText, undefined)
+      }
+      this._advance(group, this.matchText)
+    }
+  }
+
+  // Types which only an arbitrary type transform knows about get -1, rather
+  // than growing the table (which clones and cached lexers share) forever.
+  Lexer.prototype._typeId = function(type) {
+    var id = this.types.ids[type]
+    return id === undefined ? -1 : id
+  }
+
+  Lexer.prototype._token = function(group, text, offset) {
+    var line = this.line
+    var col = this.col
+    var lineBreaks = this._advance(group, text)
+
+    var type = group.defaultType
+    var typeId = group.typeId
+    if (typeof group.type === 'function') {
+      var transformed = group.type(text)
+      if (transformed) {
+        type = transformed
+        typeId = this._typeId(transformed)
+      }
+    }
+
+    var token = {
+      type: type,
+      typeId: typeId,
+      value: typeof group.value === 'function' ? group.value(text) : text,
+      text: text,
+      toString: tokenToString,
+      offset: offset,
+      lineBreaks: lineBreaks,
+      line: line,
+      col: col,
+    }
+    // nb. adding more props to token object will make V8 sad!
+
     // throw, if no rule with {error: true}
     if (group.shouldThrow) {
       var err = new Error(this.formatError(token, "invalid syntax"))
       throw err;
     }
 
-    if (group.pop) this.popState()
-    else if (group.push) this.pushState(group.push)
-    else if (group.next) this.setState(group.next)
+    return token
+  }
+
+  // With the codegen option, each state gets its own next(), which leaves out
+  // whatever the state's rules don't need. It does the same as _match() and
+  // _token().
+  function generateStates(states, options) {
+    for (var key in states) {
+      if (states[key].next === undefined) {
+        states[key].next = generateNext(states[key], options)
+      }
+    }
+  }
+
+  function generateNext(info, options) {
+    var tracking = options.positionTracking
+    var groups = []
+    function id(group) {
+      var index = groups.indexOf(group)
+      return index !== -1 ? index : groups.push(group) - 1
+    }
+    var error = id(info.error)
+    info.groups.forEach(id)
+    info.literals.forEach(id)
+
+    function union(u) {
+      return {
+        regexp: u.regexp,
+        blocks: u.blocks,
+        captures: u.captures.map(function(group) { return group ? id(group) : -1 }),
+      }
+    }
+    var full = union(info)
+    var dispatch = info.dispatch && info.dispatch.map(function(u) {
+      return u.regexp === info.regexp ? full : union(u)
+    })
+
+    var fast = Object.create(null)
+    var hasFast = false
+    for (var code in info.fast) {
+      fast[code] = id(info.fast[code])
+      hasFast = true
+    }
+    function trieNode(node) {
+      var next = Object.create(null)
+      for (var code in node.next) next[code] = trieNode(node.next[code])
+      return {next: next, group: node.group ? id(node.group) : -1, length: node.length}
+    }
+    var trie = Object.create(null)
+    var hasTrie = false
+    for (var code in info.trie) {
+      trie[code] = trieNode(info.trie[code])
+      hasTrie = true
+    }
+    var fallback = info.error.fallback
+    var skips = false
+    for (var i = 0; i < groups.length; i++) {
+      if (groups[i].skip) skips = true
+    }
+
+    // (if we skip a token, go round again)
+    var src = ['return function next() {',
+      '  if (this.peekCount) return this._unpeek()']
+    if (skips) src.push('for (;;) {')
+    src.push(
+      '  var index = this.index',
+      '  var buffer = this.buffer',
+      '  var g, text',
+      '  find: {')
+    if (fallback) src.push(
+      '    if (this.queuedGroup) {',
+      '      g = groups.indexOf(this.queuedGroup)',
+      '      text = this.queuedText',
+      '      this.queuedGroup = null',
+      '      this.queuedText = ""',
+      '      break find',
+      '    }')
+    src.push(
+      '    if (index === buffer.length) return',
+      '    var code = buffer.charCodeAt(index)')
+    if (hasFast) src.push(
+      '    g = fast[code]',
+      '    if (g !== undefined) {',
+      '      text = buffer.charAt(index)',
+      '      break find',
+      '    }')
+    if (hasTrie) src.push(
+      '    var node = trie[code]',
+      '    if (node) {',
+      '      var end = index + 1',
+      '      var child',
+      '      while ((child = node.next[buffer.charCodeAt(end)])) {',
+      '        node = child',
+      '        end++',
+      '      }',
+      '      if (node.group !== -1) {',
+      '        g = node.group',
+      '        text = buffer.substr(index, node.length)',
+      '        break find',
+      '      }',
+      '    }')
+    src.push(
+      '    var u = ' + (dispatch ? 'dispatch[code] || full' : 'full'),
+      '    var re = u.regexp',
+      '    re.lastIndex = index',
+      '    var match = eat(re, buffer)',
+      '    if (match == null) {')
+    // (error recovery is rare, so leave it to the slow path)
+    if (options.errorRecovery && !fallback) src.push(
+      '      return slow.call(this)')
+    else src.push(
+      '      g = ' + error,
+      '      text = buffer.slice(index, buffer.length)',
+      '      break find')
+    src.push(
+      '    }',
+      '    var blocks = u.blocks',
+      '    search: for (var b = 0; b < blocks.length; b++) {',
+      '      if (match[blocks[b]] !== undefined) {',
+      '        for (var j = blocks[b] + 1; j < match.length; j++) {',
+      '          if (match[j] !== undefined) {',
+      '            g = u.captures[j]',
+      '            break search',
+      '          }',
+      '        }',
+      '      }',
+      '    }',
+      '    text = match[0]')
+    if (fallback) src.push(
+      '    if (match.index !== index) {',
+      '      this.queuedGroup = groups[g]',
+      '      this.queuedText = text',
+      '      g = ' + error,
+      '      text = buffer.slice(index, match.index)',
+      '    }')
+    src.push(
+      '  }',
+      '  var line = this.line',
+      '  var col = this.col',
+      '  var size = text.length',
+      '  var lineBreaks = ' + (tracking === 'full' ? '0' : 'undefined'),
+      '  this.index = index + size',
+      '  var token',
+      '  switch (g) {')
+
+    for (var i = 0; i < groups.length; i++) {
+      var group = groups[i]
+      src.push('  case ' + i + ':')
+      if (tracking !== 'full') {
+        // no line counting
+      } else if (group.lineBreaks) src.push(
+        '    var nl = text.indexOf("\\n")',
+        '    var last = -1',
+        '    while (nl !== -1) {',
+        '      lineBreaks++',
+        '      last = nl',
+        '      nl = text.indexOf("\\n", nl + 1)',
+        '    }',
+        '    if (lineBreaks !== 0) {',
+        '      this.line = line + lineBreaks',
+        '      this.col = size - last',
+        '    } else {',
+        '      this.col = col + size',
+        '    }')
+      else src.push(
+        '    this.col = col + size')
+
+      if (group.pop) src.push('    this.popState()')
+      else if (group.push) src.push('    this.pushState(' + JSON.stringify(group.push) + ')')
+      else if (group.next) src.push('    this.setState(' + JSON.stringify(group.next) + ')')
+
+      if (group.skip) {
+        // If we're in another state now, its next() would have to take over;
+        // rather than recurse, let the slow path find the next token.
+        if (group.pop || group.push || group.next) src.push(
+          '    if (this.next !== next) return slow.call(this)')
+        src.push(
+          '    continue')
+        continue
+      }
+
+      var type = JSON.stringify(group.defaultType)
+      if (typeof group.type === 'function') src.push(
+        '    var type = groups[' + i + '].type(text)',
+        '    var typeId = type ? this._typeId(type) : ' + group.typeId,
+        '    if (!type) type = ' + type)
+      else src.push(
+        '    var type = ' + type,
+        '    var typeId = ' + group.typeId)
+
+      var value = typeof group.value === 'function' ? 'groups[' + i + '].value(text)' : 'text'
+      var offset = tracking === 'none' ? 'undefined' : 'this.base + index'
+      if (options.reuseTokens) src.push(
+        '    token = this.token',
+        '    token.type = type',
+        '    token.typeId = typeId',
+        '    token.value = ' + value,
+        '    token.text = text',
+        '    token.offset = ' + offset,
+        '    token.lineBreaks = lineBreaks',
+        '    token.line = line',
+        '    token.col = col')
+      else src.push(
+        '    token = {',
+        '      type: type,',
+        '      typeId: typeId,',
+        '      value: ' + value + ',',
+        '      text: text,',
+        '      toString: tokenToString,',
+        '      offset: ' + offset + ',',
+        '      lineBreaks: lineBreaks,',
+        '      line: line,',
+        '      col: col,',
+        '    }')
+      if (group.shouldThrow) src.push(
+        '    throw new Error(this.formatError(token, "invalid syntax"))')
+      else src.push(
+        '    return token')
+    }
+    src.push(
+      '  }',
+      '  throw new Error("Cannot find token type for matched text")')
+    if (skips) src.push('}')
+    src.push('}')
+
+    var slow = tracking === 'none' ? Lexer.prototype._nextWithoutOffset : Lexer.prototype.next
+    try {
+      var factory = new Function('groups', 'fast', 'trie', 'full', 'dispatch', 'eat', 'tokenToString', 'slow', src.join('\n'))
+    } catch (e) {
+      // e.g. a Content Security Policy which doesn't allow eval
+      return null
+    }
+    return factory(groups, fast, trie, full, dispatch, eat, tokenToString, slow)
+  }
+
+  // With the reuseTokens option, next() keeps returning the same token,
+  // overwriting it each time. Use clone() to keep one.
+  var Token = function() {
+    this.type = undefined
+    this.typeId = undefined
+    this.value = undefined
+    this.text = undefined
+    this.offset = undefined
+    this.lineBreaks = undefined
+    this.line = undefined
+    this.col = undefined
+  }
+
+  Token.prototype.toString = tokenToString
+
+  Token.prototype.clone = function() {
+    var token = new Token
+    token.type = this.type
+    token.typeId = this.typeId
+    token.value = this.value
+    token.text = this.text
+    token.offset = this.offset
+    token.lineBreaks = this.lineBreaks
+    token.line = this.line
+    token.col = this.col
+    return token
+  }
+
+  Lexer.prototype._reusedToken = function(group, text, offset) {
+    var line = this.line
+    var col = this.col
+    var lineBreaks = this._advance(group, text)
+
+    var type = group.defaultType
+    var typeId = group.typeId
+    if (typeof group.type === 'function') {
+      var transformed = group.type(text)
+      if (transformed) {
+        type = transformed
+        typeId = this._typeId(transformed)
+      }
+    }
+
+    var token = this.token
+    token.type = type
+    token.typeId = typeId
+    token.value = typeof group.value === 'function' ? group.value(text) : text
+    token.text = text
+    token.offset = offset
+    token.lineBreaks = lineBreaks
+    token.line = line
+    token.col = col
+
+    // throw, if no rule with {error: true}
+    if (group.shouldThrow) {
+      var err = new Error(this.formatError(token, "invalid syntax"))
+      throw err;
+    }
+
+    return token
+  }
+
+  // With the lazyText option, tokens only point into the buffer; their text
+  // and value are only sliced out when somebody asks for them.
+  var LazyToken = function(buffer, base, group, type, typeId, offset, length, lineBreaks, line, col) {
+    this.type = type
+    this.typeId = typeId
+    this.offset = offset
+    this.length = length
+    this.lineBreaks = lineBreaks
+    this.line = line
+    this.col = col
+    this.buffer = buffer
+    this.base = base
+    this.group = group
+  }
+
+  Object.defineProperty(LazyToken.prototype, 'text', {
+    get: function() {
+      return this.buffer.substr(this.offset - this.base, this.length)
+    },
+  })
+
+  Object.defineProperty(LazyToken.prototype, 'value', {
+    get: function() {
+      var text = this.buffer.substr(this.offset - this.base, this.length)
+      return typeof this.group.value === 'function' ? this.group.value(text) : text
+    },
+  })
+
+  LazyToken.prototype.toString = tokenToString
+
+  LazyToken.prototype.toJSON = function() {
+    return {
+      type: this.type,
+      typeId: this.typeId,
+      value: this.value,
+      text: this.text,
+      offset: this.offset,
+      lineBreaks: this.lineBreaks,
+      line: this.line,
+      col: this.col,
+    }
+  }
+
+  Lexer.prototype._lazyToken = function(group, text, offset) {
+    var line = this.line
+    var col = this.col
+    var buffer = this.buffer
+    var lineBreaks = this._advance(group, text)
+
+    var type = group.defaultType
+    var typeId = group.typeId
+    if (typeof group.type === 'function') {
+      var transformed = group.type(text)
+      if (transformed) {
+        type = transformed
+        typeId = this._typeId(transformed)
+      }
+    }
+
+    var token = new LazyToken(buffer, this.base, group, type, typeId, offset, text.length, lineBreaks, line, col)
+
+    // throw, if no rule with {error: true}
+    if (group.shouldThrow) {
+      var err = new Error(this.formatError(token, "invalid syntax"))
+      throw err;
+    }
+
+    return token
+  }
+
+  // A growable struct-of-arrays store for tokens, filled by tokenizeAll().
+  // Token i is described by types[i], offsets[i], lengths[i], lines[i] and
+  // cols[i]; only the first `length` entries of each array are meaningful.
+  var TokenTape = function(capacity, types) {
+    this.length = 0
+    this.capacity = capacity
+    this.types = new Uint16Array(capacity)
+    this.offsets = new Uint32Array(capacity)
+    this.lengths = new Uint32Array(capacity)
+    this.lines = new Uint32Array(capacity)
+    this.cols = new Uint32Array(capacity)
+    this.typeNames = types.names
+    this.typeIds = types.ids
+    this.ownTypes = false
+  }
+
+  // New types from a type transform get an id on first sight, but only on
+  // this tape; the lexer's table is left alone.
+  TokenTape.prototype._typeId = function(type) {
+    var id = this.typeIds[type]
+    if (id === undefined) {
+      if (!this.ownTypes) {
+        this.typeNames = this.typeNames.slice()
+        this.typeIds = Object.create(this.typeIds)
+        this.ownTypes = true
+      }
+      id = this.typeIds[type] = this.typeNames.length
+      this.typeNames.push(type)
+    }
+    return id
+  }
+
+  TokenTape.prototype.push = function(type, offset, length, line, col) {
+    var i = this.length
+    if (i === this.capacity) this._grow(i * 2)
+    if (type > 0xffff && this.types.BYTES_PER_ELEMENT === 2) {
+      // only type transforms can make this many types
+      var types = new Uint32Array(this.capacity)
+      types.set(this.types)
+      this.types = types
+    }
+    this.types[i] = type
+    this.offsets[i] = offset
+    this.lengths[i] = length
+    this.lines[i] = line
+    this.cols[i] = col
+    this.length = i + 1
+  }
+
+  TokenTape.prototype._grow = function(capacity) {
+    function resize(array) {
+      var result = new array.constructor(capacity)
+      result.set(array)
+      return result
+    }
+    this.types = resize(this.types)
+    this.offsets = resize(this.offsets)
+    this.lengths = resize(this.lengths)
+    this.lines = resize(this.lines)
+    this.cols = resize(this.cols)
+    this.capacity = capacity
+  }
+
+  // The ArrayBuffers backing the tape, for use as the transfer list of
+  // postMessage(), so the tape can be sent to a worker without copying.
+  TokenTape.prototype.buffers = function() {
+    return [
+      this.types.buffer,
+      this.offsets.buffer,
+      this.lengths.buffer,
+      this.lines.buffer,
+      this.cols.buffer,
+    ]
+  }
+
+  Lexer.prototype.tokenizeAll = function(data, info) {
+    this.reset(data, info)
+    var tape = new TokenTape(Math.max(16, this.buffer.length >> 3), this.types)
+    var group
+    while (group = this._match()) {
+      this._tapeToken(tape, group)
+    }
+    return tape
+  }
+
+  Lexer.prototype._tapeToken = function(tape, group) {
+    var text = this.matchText
+    var offset = this.base + this.index
+    var line = this.line
+    var col = this.col
+    var typeId = group.typeId
+    if (typeof group.type === 'function' && !group.skip) {
+      var transformed = group.type(text)
+      if (transformed) typeId = tape._typeId(transformed)
+    }
+    this._advance(group, text)
+
+    if (group.shouldThrow) {
+      var token = {text: text, offset: offset, line: line, col: col}
+      throw new Error(this.formatError(token, "invalid syntax"))
+    }
+
+    if (!group.skip) tape.push(typeId, offset, text.length, line, col)
+  }
+
+  // Parallel lexing: split the input into chunks at line starts, lex each
+  // chunk in a worker thread, and stitch the tapes back together.
+  //
+  // A chunk might not start at the start of a token (say, in the middle of
+  // some whitespace), so we only trust a chunk's tokens once the lexer is in
+  // step with them: we lex from the end of the previous chunk's tokens until
+  // we reach the start of one of this chunk's tokens, in the same state as
+  // the worker had there. The tokens from there on are the ones we would have
+  // got anyway.
+  //
+  // We don't know which state each chunk starts in, so the workers guess
+  // (the start state, unless you pass a `guess` function). If the guess was
+  // wrong, the worker's tokens are no use until it happens to get back in
+  // step with us, so we lex the chunk again ourselves. We don't know what's
+  // on the stack either, so the workers start with an empty one; their stack
+  // has to match the top of ours, and they mustn't pop more than they pushed
+  // after that.
+  //
+  // The end of a chunk is trickier: a rule which spans lines, like a block
+  // comment, might not match because its end is in the next chunk, and then
+  // the worker would lex the comment as something else. So we only allow
+  // rules which can't give up half way through a line break (see
+  // splitsLines()), and RegExps which don't look around.
+  function parallel(lexer, input, options) {
+    if (typeof require !== 'function' || typeof __filename !== 'string') { /* global __filename */
+      return Promise.reject(new Error('moo.parallel() needs worker_threads'))
+    }
+    // Workers don't need values (tapes don't have them); but other type
+    // transforms would have to be sent to them, which we can't do.
+    var functions = {}
+    var groups = allGroups(lexer.states)
+    for (var i = 0; i < groups.length; i++) {
+      var group = groups[i]
+      if (typeof group.type === 'function' && !group.type.keywords) {
+        return Promise.reject(new Error("moo.parallel() can't send type transforms to workers (for token '" + group.defaultType + "')"))
+      }
+      if (!splitsLines(group)) {
+        return Promise.reject(new Error("moo.parallel() can't split the input between lines, since a token might span them (for token '" + group.defaultType + "')"))
+      }
+      if (typeof group.value === 'function') functions['value' + i] = group.value
+    }
+
+    if (lexer.options.errorRecovery) {
+      return Promise.reject(new Error("moo.parallel() can't collect errors from workers (use errorRecovery: false)"))
+    }
+
+    var count = options && options.workers || require('os').cpus().length
+    var guess = options && options.guess
+    var size = Math.ceil(input.length / count)
+    var starts = [0]
+    for (var i = 1; i < count; i++) {
+      var start = input.indexOf('\n', i * size) + 1
+      if (start === 0) break
+      if (start > starts[starts.length - 1] && start < input.length) starts.push(start)
+    }
+    if (starts.length === 1) {
+      return new Promise(function(resolve) {
+        var tape = new Lexer(lexer.states, lexer.startState, lexer.types, lexer.options).tokenizeAll(input)
+        tape.chunks = 1
+        tape.relexed = 0
+        resolve(tape)
+      })
+    }
+
+    var json = serialize(lexer, functions)
+    var names = Object.getOwnPropertyNames(functions)
+
+    return Promise.all(starts.map(function(start, i) {
+      var isLast = i === starts.length - 1
+      var end = isLast ? input.length : starts[i + 1]
+      var state = i === 0 ? lexer.startState : guess ? guess(input, start) : lexer.startState
+      if (!lexer.states[state]) {
+        return Promise.reject(new Error("moo.parallel() guessed a missing state '" + state + "'"))
+      }
+      return runInWorker({
+        lexer: json,
+        functions: names,
+        text: input.slice(start, end),
+        isLast: isLast,
+        state: state,
+      })
+    })).then(function(results) {
+      var main = new Lexer(lexer.states, lexer.startState, lexer.types, lexer.options)
+      return stitch(main, input, starts, results)
+    })
+  }
+
+  // The workers are kept between calls, so we only pay for starting them (and
+  // loading moo into them) once. Each one remembers the last lexer it was
+  // sent. Idle workers are unref()ed, so they don't keep the process alive.
+  var workers = []
+  var idleWorkers = []
+
+  var workerSource = function() {
+    return [
+      "var threads = require('worker_threads')",
+      "var moo = require(" + JSON.stringify(__filename) + ")",
+      "var json, lexer",
+      "threads.parentPort.on('message', function(data) {",
+      "  if (data.lexer !== json) {",
+      "    var functions = {}",
+      "    data.functions.forEach(function(name) { functions[name] = String })",
+      "    lexer = moo.deserialize(data.lexer, functions)",
+      "    json = data.lexer",
+      "  }",
+      "  var result = moo.parallel.lexChunk(lexer, data.text, data.isLast, data.state)",
+      "  threads.parentPort.postMessage(result, result.tape.buffers())",
+      "})",
+    ].join('\n')
+  }
+
+  function runInWorker(data) {
+    var worker = idleWorkers.pop()
+    if (!worker) {
+      var Worker = require('worker_threads').Worker
+      worker = new Worker(workerSource(), {eval: true})
+      workers.push(worker)
+    }
+    worker.ref()
+    return new Promise(function(resolve, reject) {
+      function done() {
+        worker.removeListener('message', onMessage)
+        worker.removeListener('error', onError)
+        worker.removeListener('exit', onExit)
+      }
+      function onMessage(result) {
+        done()
+        worker.unref()
+        idleWorkers.push(worker)
+        resolve(result)
+      }
+      function onError(err) {
+        done()
+        forgetWorker(worker)
+        reject(err)
+      }
+      function onExit(code) {
+        done()
+        forgetWorker(worker)
+        reject(new Error('moo.parallel() worker stopped with exit code ' + code))
+      }
+      worker.on('message', onMessage)
+      worker.on('error', onError)
+      worker.on('exit', onExit)
+      worker.postMessage(data)
+    })
+  }
+
+  function forgetWorker(worker) {
+    var i = workers.indexOf(worker)
+    if (i !== -1) workers.splice(i, 1)
+  }
+
+  // Stop the workers. (parallel() will start new ones if it's called again.)
+  parallel.close = function() {
+    var stopping = workers
+    workers = []
+    idleWorkers = []
+    return Promise.all(stopping.map(function(worker) { return worker.terminate() }))
+  }
+
+  // Every rule in every state (literals included), for checking them all.
+  function allGroups(states) {
+    var groups = []
+    var keys = Object.getOwnPropertyNames(states)
+    for (var i = 0; i < keys.length; i++) {
+      var info = states[keys[i]]
+      groups.push.apply(groups, info.groups.concat(info.literals, [info.error]))
+    }
+    return groups
+  }
+
+  // Is every line start safe to split the input at, as far as this rule is
+  // concerned? It is if the rule can't match a line break, or if it only
+  // matches one line break at the end of its tokens (like /\r?\n/), or if it
+  // matches whitespace (like /\s/ or /\s+/), since then the token which ends
+  // at the end of the chunk is held back. The error and fallback rules are
+  // fine too, for the same reason.
+  function splitsLines(group) {
+    if (group.error || group.fallback) return true
+    for (var i = 0; i < group.match.length; i++) {
+      var match = group.match[i]
+      if (isRegExp(match)) {
+        if (/\(\?<?[=!]/.test(match.source)) return false
+        if (group.lineBreaks && !/^(?:(?:(?:\\r|\r)\??)?(?:\\n|\n)|(?:\\[sn]|\n|\[(?:\\[nrtfv]|[ \t\r\n])+\])[+*]?)$/.test(match.source)) {
+          return false
+        }
+      } else {
+        var nl = match.indexOf('\n')
+        if (nl !== -1 && nl !== match.length - 1) return false
+      }
+    }
+    return true
+  }
+
+  // Lex one chunk of the input, for parallel(). Like feed(), we leave out the
+  // tokens which might change if we could see the rest of the input; unlike
+  // it, we stop before errors instead of throwing, since they might not be
+  // errors once we know where the chunk's first token starts.
+  //
+  // For each token, we also record the state and stack we lexed it in. Each
+  // different stack gets a number, so we don't have to copy them. We note the
+  // last time we popped an empty stack, too, since we were probably wrong
+  // about what's on it.
+  function lexChunk(lexer, text, isLast, state) {
+    lexer.reset(text)
+    lexer.setState(state)
+    var tape = new TokenTape(Math.max(16, text.length >> 3), lexer.types)
+    var stateNames = Object.getOwnPropertyNames(lexer.states)
+    var stateIds = Object.create(null)
+    for (var i = 0; i < stateNames.length; i++) stateIds[stateNames[i]] = i
+    var states = new Uint16Array(tape.capacity)
+    var stacks = new Uint32Array(tape.capacity)
+    var stackList = [[]]
+    var stackIds = {'[]': 0}
+    var stackId = 0
+
+    var guess = state
+    var underflow = -1
+    var end = 0
+    var endStack = 0
+    var line = lexer.line
+    var col = lexer.col
+    var group
+    while (group = lexer._match()) {
+      var matchEnd = lexer.index + lexer.matchText.length
+      if (lexer.queuedGroup) matchEnd += lexer.queuedText.length
+      if (!isLast && matchEnd === text.length) {
+        // hold back the token before it too, in case this one could've been
+        // longer (see _drain())
+        if (tape.length) {
+          tape.length--
+          end = tape.offsets[tape.length]
+          line = lexer.line === undefined ? undefined : tape.lines[tape.length]
+          col = lexer.col === undefined ? undefined : tape.cols[tape.length]
+          state = stateNames[states[tape.length]]
+          endStack = stacks[tape.length]
+        }
+        break
+      }
+      if (group.shouldThrow) break
+
+      var n = tape.length
+      if (n === states.length) {
+        var grown = new Uint16Array(n * 2)
+        grown.set(states)
+        states = grown
+        grown = new Uint32Array(n * 2)
+        grown.set(stacks)
+        stacks = grown
+      }
+      states[n] = stateIds[lexer.state]
+      stacks[n] = stackId
+      if (group.pop && !lexer.stack.length) underflow = n
+      lexer._tapeToken(tape, group)
+      if (group.push || group.pop) {
+        var stack = lexer.stack.toArray()
+        var key = JSON.stringify(stack)
+        stackId = stackIds[key]
+        if (stackId === undefined) {
+          stackId = stackIds[key] = stackList.push(stack) - 1
+        }
+      }
+      if (!group.skip) {
+        end = lexer.index
+        line = lexer.line
+        col = lexer.col
+        state = lexer.state
+        endStack = stackId
+      }
+    }
+    return {
+      tape: tape,
+      end: end,
+      line: line,
+      col: col,
+      state: state,
+      stack: stackList[endStack],
+      guess: guess,
+      underflow: underflow,
+      stateNames: stateNames,
+      states: states,
+      stacks: stacks,
+      stackList: stackList,
+    }
+  }
+
+  function stitch(lexer, input, starts, results) {
+    lexer.reset(input)
+    var tape = new TokenTape(Math.max(16, input.length >> 3), lexer.types)
+    var full = lexer.line !== undefined
+    var relexed = 0
+    var group
+    for (var k = 0; k < starts.length; k++) {
+      var start = starts[k]
+      var result = results[k]
+      var chunk = result.tape
+      // (the worker's type ids might not be ours, if the types are dynamic)
+      var ids = chunk.typeNames.map(tape._typeId, tape)
+      var checked = false
+      var j = 0
+      while (lexer.index < start + result.end) {
+        var index = lexer.index
+        if (index >= start && !lexer.queuedGroup) {
+          while (j < chunk.length && chunk.offsets[j] + start < index) j++
+          if (!checked) {
+            // was the worker's guess right?
+            checked = true
+            if (lexer.state !== result.guess) relexed++
+          }
+          var stack = j < chunk.length && result.stackList[result.stacks[j]]
+          var depth = lexer.stack.length - (stack && stack.length)
+          if (j < chunk.length && chunk.offsets[j] + start === index &&
+              result.stateNames[result.states[j]] === lexer.state &&
+              stackEndsWith(lexer.stack, stack) && (depth === 0 || j > result.underflow)) {
+            // back in step: copy the rest of the chunk's tokens
+            var syncLine = chunk.lines[j]
+            var lineDelta = full ? lexer.line - syncLine : 0
+            var colDelta = full ? lexer.col - chunk.cols[j] : 0
+            for (var i = j; i < chunk.length; i++) {
+              var line = chunk.lines[i]
+              tape.push(ids[chunk.types[i]], chunk.offsets[i] + start, chunk.lengths[i],
+                line + lineDelta, line === syncLine ? chunk.cols[i] + colDelta : chunk.cols[i])
+            }
+            lexer.index = start + result.end
+            if (full) {
+              lexer.line = result.line + lineDelta
+              lexer.col = result.line === syncLine ? result.col + colDelta : result.col
+            }
+            lexer.setState(result.state)
+            var bottom = lexer.stack
+            while (bottom.length > depth) bottom = bottom.below
+            for (var i = 0; i < result.stack.length; i++) {
+              bottom = new StateStack(result.stack[i], bottom)
+            }
+            lexer.stack = bottom
+            break
+          }
+        }
+        if (!(group = lexer._match())) break
+        lexer._tapeToken(tape, group)
+      }
+    }
+    while (group = lexer._match()) {
+      lexer._tapeToken(tape, group)
+    }
+    tape.chunks = starts.length
+    tape.relexed = relexed
+    return tape
+  }
+
+  function stackEndsWith(stack, top) {
+    if (stack.length < top.length) return false
+    for (var i = top.length; i--; stack = stack.below) {
+      if (stack.state !== top[i]) return false
+    }
+    return true
+  }
+
+  parallel.lexChunk = lexChunk
+
+  // Streaming input: feed() the lexer chunks of the input as they arrive, and
+  // then call end(). Both return the tokens which are now complete.
+  Lexer.prototype.feed = function(chunk) {
+    // drop the input we've consumed, so memory is bounded by the longest token
+    this._dropLines(this.base + this.index)
+    this.buffer = this.buffer.slice(this.index) + chunk
+    this.base += this.index
+    this.index = 0
+    return this._drain(false)
+  }
+
+  Lexer.prototype.end = function() {
+    return this._drain(true)
+  }
+
+  Lexer.prototype._drain = function(isLast) {
+    var tokens = []
+    // A rule can give up on a match because it ran out of input long before
+    // the end of it (think of an unclosed string, when a lone quote is a
+    // token too). So we only trust tokens which end before the last line
+    // start, which is safe as long as no rule can match across one (see
+    // splitsLines()); if one can, we hold on to everything until end().
+    var safe = this.buffer.length
+    if (!isLast) {
+      if (this.splitsLines === undefined) {
+        this.splitsLines = allGroups(this.states).every(splitsLines)
+      }
+      safe = this.splitsLines ? this.buffer.lastIndexOf('\n') + 1 : 0
+    }
+    var group
+    while (group = this._match()) {
+      var text = this.matchText
+      // A token which reaches the last line start could still change, once we
+      // know what comes next (say, a run of whitespace); so hold it back. If
+      // a fallback token is followed by a match which reaches it, that counts
+      // too.
+      var end = this.index + text.length
+      if (this.queuedGroup) end += this.queuedText.length
+      if (!isLast && end >= safe) {
+        this.queuedGroup = null
+        this.queuedText = ""
+        this._forgetErrors()
+        return tokens
+      }
+      if (group.skip) {
+        this._advance(group, text)
+        continue
+      }
+      var token = this._token(group, text, this.base + this.index)
+      tokens.push(token === this.token ? token.clone() : token)
+    }
+    return tokens
+  }
+
+  Lexer.prototype._rewind = function(info) {
+    this.index = info.index
+    this.line = info.line
+    this.col = info.col
+    this.queuedGroup = null
+    this.queuedText = ""
+    this.setState(info.state)
+    this.stack = info.stack
+    this._forgetErrors()
+  }
 
+  // Incremental lexing: lex a document once, and then keep its tokens up to
+  // date as it is edited. We record the lexer's state every so often while
+  // lexing; after an edit we re-lex from the last of these checkpoints before
+  // it, and stop as soon as we're back in step with the old tokens.
+  Lexer.prototype.incremental = function(text, interval) {
+    var lexer = new Lexer(this.states, this.startState, this.types, this.options)
+    return new Incremental(lexer, text || '', interval || 32)
+  }
+
+  var Incremental = function(lexer, text, interval) {
+    this.lexer = lexer
+    this.interval = interval
+    this.stateless = Object.getOwnPropertyNames(lexer.states).length === 1
+    this.splitsLines = allGroups(lexer.states).every(splitsLines)
+    this.spanning = this.splitsLines ? null : spanningRegExps(lexer.states)
+    // the state we lexed each token in, if we need it for that
+    this.states = this.stateless || this.splitsLines ? null : []
+    this.text = ''
+    this.tokens = []
+    this.checkpoints = [{
+      token: 0,
+      index: 0,
+      line: lexer.line,
+      col: lexer.col,
+      state: lexer.startState,
+      stack: emptyStack,
+    }]
+    this.edit(0, 0, text)
+  }
+
+  // Replace `deletedLength` characters at `offset` with `insertedText`.
+  // Updates `tokens`, and returns the change as a splice: the `removed`
+  // tokens starting at `index` were replaced with `tokens`.
+  Incremental.prototype.edit = function(offset, deletedLength, insertedText) {
+    var oldText = this.text
+    if (offset < 0 || offset + deletedLength > oldText.length) {
+      throw new Error('Edit is outside the text')
+    }
+    var text = oldText.slice(0, offset) + insertedText + oldText.slice(offset + deletedLength)
+    var delta = insertedText.length - deletedLength
+    var editEnd = offset + insertedText.length
+    var tokens = this.tokens
+    var checkpoints = this.checkpoints
+    var interval = this.interval
+
+    // Re-lex from the token before the one touching the edit, in case its
+    // RegExp looked ahead into the edited text; or from the start of the line,
+    // since a rule might have given up on a longer match anywhere on it (an
+    // unclosed string, say). If a token might span lines too, look further
+    // back.
+    var touching = searchOffsets(tokens, offset) - 1
+    var lineStart = oldText.lastIndexOf('\n', offset - 1) + 1
+    var first = Math.min(touching - 1, searchOffsets(tokens, lineStart) - 1)
+    if (!this.splitsLines) first = this._reachingBack(text, offset, first)
+    // (before the first token, start from the very start, in case we skipped
+    // something there)
+    var checkpoint = first < 0 ? checkpoints[0] : checkpoints[searchTokens(checkpoints, first + 1) - 1]
+
+    var lexer = this.lexer
+    lexer.reset(text)
+    lexer._rewind(checkpoint)
+
+    var newTokens = []
+    var newStates = []
+    var newCheckpoints = []
+    var old = checkpoint.token
+    var synced
+    while (true) {
+      var group = lexer._match()
+      while (group && group.skip) {
+        lexer._advance(group, lexer.matchText)
+        group = lexer._match()
+      }
+      var index = lexer.index
+      if (index >= editEnd) {
+        // Look for an old token starting here
+        while (old < tokens.length && tokens[old].offset + delta < index) old++
+        if (old < tokens.length && tokens[old].offset + delta === index && this._inStep(old)) {
+          synced = old
+          break
+        }
+      }
+      if (newTokens.length % interval === 0 && newTokens.length && index < text.length && !lexer.queuedGroup) {
+        newCheckpoints.push({
+          token: checkpoint.token + newTokens.length,
+          index: index,
+          line: lexer.line,
+          col: lexer.col,
+          state: lexer.state,
+          stack: lexer.stack,
+        })
+      }
+      if (!group) {
+        synced = tokens.length
+        break
+      }
+      if (this.states) newStates.push(lexer.state)
+      var token = lexer._token(group, lexer.matchText, lexer.base + index)
+      if (token === lexer.token) token = token.clone()
+      newTokens.push(token)
+    }
+
+    // Shift the positions of the tokens after the edit
+    var removed = synced - checkpoint.token
+    var cpIndex = checkpoints.indexOf(checkpoint)
+    var next = synced < tokens.length ? searchTokens(checkpoints, synced) : checkpoints.length
+    // (if we got back in step straight away, keep the checkpoint we started from)
+    next = Math.max(next, cpIndex + 1)
+    if (synced < tokens.length && lexer.line === undefined) {
+      for (var i = synced; i < tokens.length; i++) {
+        tokens[i].offset += delta
+        if (tokens[i] instanceof LazyToken) tokens[i].base += delta
+      }
+      for (var i = next; i < checkpoints.length; i++) {
+        checkpoints[i].index += delta
+        checkpoints[i].token += newTokens.length - removed
+      }
+    } else if (synced < tokens.length) {
+      var syncLine = tokens[synced].line
+      var lineDelta = lexer.line - syncLine
+      var colDelta = lexer.col - tokens[synced].col
+      for (var i = synced; i < tokens.length; i++) {
+        var tok = tokens[i]
+        if (tok.line === syncLine) tok.col += colDelta
+        tok.line += lineDelta
+        tok.offset += delta
+        if (tok instanceof LazyToken) tok.base += delta
+      }
+      var tokenDelta = newTokens.length - removed
+      for (var i = next; i < checkpoints.length; i++) {
+        var cp = checkpoints[i]
+        if (cp.line === syncLine) cp.col += colDelta
+        cp.line += lineDelta
+        cp.index += delta
+        cp.token += tokenDelta
+      }
+    }
+
+    replaceRange(checkpoints, cpIndex + 1, next - cpIndex - 1, newCheckpoints)
+    replaceRange(tokens, checkpoint.token, removed, newTokens)
+    if (this.states) replaceRange(this.states, checkpoint.token, removed, newStates)
+    this.text = text
+    return {index: checkpoint.token, removed: removed, tokens: newTokens}
+  }
+
+  // The first old token which might change now, when a rule could match
+  // across lines: that means a match for it starting before `first` which
+  // reaches the edit (if the edit closed a block comment, say). The lexer
+  // only tries to match where an old token starts, or a skipped one, which
+  // is somewhere in the gap before the next token. (-1 means we lex from the
+  // very start.)
+  Incremental.prototype._reachingBack = function(text, offset, first) {
+    var tokens = this.tokens
+    var states = this.states
+    for (var i = Math.min(first, tokens.length - 1); i >= 0; i--) {
+      var regexps = this.spanning[states ? states[i] : this.lexer.startState]
+      if (!regexps.length) continue
+      if (i < first && reachesFrom(regexps, text, tokens[i].offset, offset)) {
+        first = i
+      }
+      // (a match in the gap means we lex from the token before it)
+      var start = i > 0 ? tokens[i - 1].offset + tokens[i - 1].text.length : 0
+      for (var p = tokens[i].offset - 1; p >= start; p--) {
+        if (reachesFrom(regexps, text, p, offset)) first = i - 1
+      }
+    }
+    return first
+  }
+
+  // For each state, RegExps for the rules which might match across lines
+  // (see splitsLines()), to try at any index.
+  function spanningRegExps(states) {
+    var spanning = {}
+    var keys = Object.getOwnPropertyNames(states)
+    for (var i = 0; i < keys.length; i++) {
+      var info = states[keys[i]]
+      spanning[keys[i]] = info.groups.concat(info.literals).filter(function(group) {
+        return !splitsLines(group)
+      }).map(function(group) {
+        var unicode = group.match.some(function(match) { return match.unicode })
+        return new RegExp(reUnion(group.match.map(regexpOrLiteral)), (hasSticky ? 'ym' : 'gm') + (unicode ? 'u' : ''))
+      })
+    }
+    return spanning
+  }
+
+  // Does one of the RegExps match at `index`, up to or past `offset`?
+  function reachesFrom(regexps, text, index, offset) {
+    for (var i = 0; i < regexps.length; i++) {
+      var re = regexps[i]
+      re.lastIndex = index
+      var match = re.exec(text)
+      if (match && match.index === index && index + match[0].length >= offset) return true
+    }
+    return false
+  }
+
+  // Like array.splice(start, count, ...items); but passing lots of items as
+  // arguments would overflow the call stack, so copy big ones ourselves.
+  function replaceRange(array, start, count, items) {
+    if (items.length <= 4096) {
+      array.splice.apply(array, [start, count].concat(items))
+      return
+    }
+    var tail = array.slice(start + count)
+    array.length = start
+    for (var i = 0; i < items.length; i++) array.push(items[i])
+    for (var i = 0; i < tail.length; i++) array.push(tail[i])
+  }
+
+  // Is the lexer in the same state as it was before the old token `i`?
+  Incremental.prototype._inStep = function(i) {
+    if (this.stateless) return true
+    var checkpoints = this.checkpoints
+    var cp = checkpoints[searchTokens(checkpoints, i + 1) - 1]
+    if (cp.token !== i) return false
+    var lexer = this.lexer
+    return lexer.state === cp.state && sameStack(lexer.stack, cp.stack)
+  }
+
+  // The number of tokens which start before `offset`.
+  function searchOffsets(tokens, offset) {
+    var lo = 0
+    var hi = tokens.length
+    while (lo < hi) {
+      var mid = (lo + hi) >>> 1
+      if (tokens[mid].offset < offset) lo = mid + 1
+      else hi = mid
+    }
+    return lo
+  }
+
+  // The number of checkpoints before token `i`.
+  function searchTokens(checkpoints, i) {
+    var lo = 0
+    var hi = checkpoints.length
+    while (lo < hi) {
+      var mid = (lo + hi) >>> 1
+      if (checkpoints[mid].token < i) lo = mid + 1
+      else hi = mid
+    }
+    return lo
+  }
+
+  // Find the line and column of an offset, without tracking them for every
+  // token. We only build the table of where each line starts once somebody
+  // asks for a position, and then only as far as we've been asked.
+  Lexer.prototype.positionAt = function(offset) {
+    if (!(offset >= 0 && offset <= this.base + this.buffer.length)) {
+      throw new Error('Offset ' + offset + ' is outside the input')
+    }
+    if (offset < this.firstStart) {
+      throw new Error('Offset ' + offset + ' is on a line which feed() has dropped')
+    }
+    if (offset >= this.lineScan) {
+      this._indexLines(offset + 1)
+    }
+    // The number of lines starting at or before `offset`
+    var starts = this.lineStarts
+    var lo = 0
+    var hi = starts.length
+    while (lo < hi) {
+      var mid = (lo + hi) >>> 1
+      if (starts[mid] <= offset) lo = mid + 1
+      else hi = mid
+    }
+    return {line: this.firstLine + lo - 1, col: offset - starts[lo - 1] + 1}
+  }
+
+  // Add the lines which start before `end` to the table.
+  Lexer.prototype._indexLines = function(end) {
+    var starts = this.lineStarts
+    if (!starts) {
+      starts = this.lineStarts = [this.firstStart]
+    }
+    var buffer = this.buffer
+    var base = this.base
+    var nl = buffer.indexOf('\n', this.lineScan - base)
+    while (nl !== -1 && base + nl < end) {
+      starts.push(base + nl + 1)
+      nl = buffer.indexOf('\n', nl + 1)
+    }
+    if (end > this.lineScan) this.lineScan = end
+  }
+
+  // Before feed() drops the input up to `end`: if positionAt() has been used,
+  // keep indexing its lines. Otherwise just count them, so that we can still
+  // find positions from the last of them on, without keeping a table that
+  // grows with the input.
+  Lexer.prototype._dropLines = function(end) {
+    if (this.lineStarts) {
+      this._indexLines(end)
+      return
+    }
+    var buffer = this.buffer
+    var base = this.base
+    var nl = buffer.indexOf('\n')
+    while (nl !== -1 && base + nl < end) {
+      this.firstLine++
+      this.firstStart = base + nl + 1
+      nl = buffer.indexOf('\n', nl + 1)
+    }
+  }
+
+  // Look ahead: return the k-th token that next() will return (the next one,
+  // by default), or undefined if there aren't that many. We keep the tokens
+  // we've looked at in a ring buffer, so next() doesn't have to lex them
+  // again; along with where we were before each one, for save().
+  Lexer.prototype.peek = function(k) {
+    if (k === undefined) k = 1
+    if (!(k >= 1 && Math.floor(k) === k)) {
+      throw new Error("peek() needs a whole number of tokens, 1 or more (not " + k + ")")
+    }
+    var count = this.peekCount
+    while (count < k) {
+      // make next() lex, rather than take tokens from the buffer
+      this.peekCount = 0
+      try {
+        var info = this.save()
+        var token = this.next()
+      } finally {
+        this.peekCount = count
+      }
+      if (!token) return
+      if (token === this.token) token = token.clone()
+
+      var peeked = this.peeked
+      if (count === peeked.length) {
+        this._growPeeked()
+        peeked = this.peeked
+      }
+      var i = (this.peekHead + count) & (peeked.length - 1)
+      peeked[i] = token
+      this.peekedInfo[i] = info
+      count = ++this.peekCount
+    }
+    return this.peeked[(this.peekHead + k - 1) & (this.peeked.length - 1)]
+  }
+
+  Lexer.prototype._unpeek = function() {
+    var i = this.peekHead
+    var token = this.peeked[i]
+    this.peeked[i] = this.peekedInfo[i] = undefined
+    this.peekHead = (i + 1) & (this.peeked.length - 1)
+    this.peekCount--
     return token
   }
 
+  Lexer.prototype._growPeeked = function() {
+    var size = this.peeked.length
+    var capacity = Math.max(4, size * 2)
+    var peeked = new Array(capacity)
+    var peekedInfo = new Array(capacity)
+    for (var i = 0; i < size; i++) {
+      var j = (this.peekHead + i) & (size - 1)
+      peeked[i] = this.peeked[j]
+      peekedInfo[i] = this.peekedInfo[j]
+    }
+    this.peeked = peeked
+    this.peekedInfo = peekedInfo
+    this.peekHead = 0
+  }
+
+  // Lex the rest of the buffer, calling `callback` with each token. Return
+  // false from the callback to stop early.
+  Lexer.prototype.scan = function(callback) {
+    var token
+    while (token = this.next()) {
+      if (callback(token) === false) break
+    }
+  }
+
+  // Lex the rest of the buffer, folding the tokens into one value.
+  Lexer.prototype.reduce = function(fn, value) {
+    var token
+    while (token = this.next()) {
+      value = fn(value, token)
+    }
+    return value
+  }
+
   if (typeof Symbol !== 'undefined' && Symbol.iterator) {
     var LexerIterator = function(lexer) {
       this.lexer = lexer
@@ -592,45 +2999,62 @@
   Lexer.prototype.formatError = function(token, message) {
     if (token == null) {
       // An undefined token indicates EOF
-      var text = this.buffer.slice(this.index)
       var token = {
-        text: text,
-        offset: this.index,
-        lineBreaks: text.indexOf('\n') === -1 ? 0 : 1,
+        offset: this.base + this.index,
         line: this.line,
         col: this.col,
       }
     }
-    
+    if (token.offset === undefined) return message
+
+    var line = token.line
+    var col = token.col
+    if (line === undefined) {
+      // positionTracking is 'offset'
+      var position = this.positionAt(token.offset)
+      line = position.line
+      col = position.col
+    }
+
+    // Only look at the lines around the token, however big the buffer is
     var numLinesAround = 2
-    var firstDisplayedLine = Math.max(token.line - numLinesAround, 1)
-    var lastDisplayedLine = token.line + numLinesAround
+    var buffer = this.buffer
+    var index = Math.min(Math.max(token.offset - this.base, 0), buffer.length)
+    var start = lineStart(buffer, index)
+    var firstDisplayedLine = line
+    while (firstDisplayedLine > Math.max(line - numLinesAround, 1) && start > 0) {
+      start = lineStart(buffer, start - 1)
+      firstDisplayedLine--
+    }
+    var lastDisplayedLine = line + numLinesAround
     var lastLineDigits = String(lastDisplayedLine).length
-    var displayedLines = lastNLines(
-        this.buffer, 
-        (this.line - token.line) + numLinesAround + 1
-      )
-      .slice(0, 5)
+    var displayedLines = []
+    for (var lineNo = firstDisplayedLine; lineNo <= lastDisplayedLine; lineNo++) {
+      var nl = buffer.indexOf('\n', start)
+      displayedLines.push(buffer.slice(start, nl === -1 ? buffer.length : nl))
+      if (nl === -1) break
+      start = nl + 1
+    }
+
     var errorLines = []
-    errorLines.push(message + " at line " + token.line + " col " + token.col + ":")
+    errorLines.push(message + " at line " + line + " col " + col + ":")
     errorLines.push("")
     for (var i = 0; i < displayedLines.length; i++) {
-      var line = displayedLines[i]
       var lineNo = firstDisplayedLine + i
-      errorLines.push(pad(String(lineNo), lastLineDigits) + "  " + line);
-      if (lineNo === token.line) {
-        errorLines.push(pad("", lastLineDigits + token.col + 1) + "^")
+      errorLines.push(pad(String(lineNo), lastLineDigits) + "  " + displayedLines[i]);
+      if (lineNo === line) {
+        errorLines.push(pad("", lastLineDigits + col + 1) + "^")
       }
     }
     return errorLines.join("\n")
   }
 
   Lexer.prototype.clone = function() {
-    return new Lexer(this.states, this.state)
+    return new Lexer(this.states, this.state, this.types, this.options)
   }
 
   Lexer.prototype.has = function(tokenType) {
-    return true
+    return this.types.dynamic || this.types.ids[tokenType] !== undefined
   }
 
 
@@ -640,6 +3064,10 @@
     error: Object.freeze({error: true}),
     fallback: Object.freeze({fallback: true}),
     keywords: keywordTransform,
+    cache: lexerCache,
+    serialize: serialize,
+    deserialize: deserialize,
+    parallel: parallel,
   }
 
 }));
@@ -17,6 +17,12 @@ function randomChoice(array) {
 const chevrotain = require('chevrotain')
 function chevrotainFromMoo(lexer) {
   const tokens = []
+  lexer.states[lexer.state].literals.forEach(group => {
+    var words = group.match.filter(word => word.length > 1)
+    if (!words.length || lexer.groups.indexOf(group) !== -1) return
+    var pat = new RegExp(words.map(reEscape).join('|'))
+    tokens.push(chevrotain.createToken({name: group.defaultType, pattern: pat}))
+  })
   var keys = Object.keys(lexer.fast)
   for (var i=0; i<keys.length; i++) {
     var charCode = keys[i]
@@ -36,23 +42,34 @@ function chevrotainFromMoo(lexer) {
 
 suite('startup', () => {
 
+  const states = () => ({
+    main: {
+      strstart: {match: '`', push: 'lit'},
+      ident:    /\w+/,
+      lbrace:   {match: '{', push: 'main'},
+      rbrace:   {match: '}', pop: true},
+      colon:    ':',
+      space:    {match: /\s+/, lineBreaks: true},
+    },
+    lit: {
+      interp:   {match: '${', push: 'main'},
+      escape:   /\\./,
+      strend:   {match: '`', pop: true},
+      const:    {match: /(?:[^$`]|\$(?!\{))+/, lineBreaks: true},
+    },
+  })
+
   benchmark('moo.compileStates', () => {
-    moo.states({
-      main: {
-        strstart: {match: '`', push: 'lit'},
-        ident:    /\w+/,
-        lbrace:   {match: '{', push: 'main'},
-        rbrace:   {match: '}', pop: true},
-        colon:    ':',
-        space:    {match: /\s+/, lineBreaks: true},
-      },
-      lit: {
-        interp:   {match: '${', push: 'main'},
-        escape:   /\\./,
-        strend:   {match: '`', pop: true},
-        const:    {match: /(?:[^$`]|\$(?!\{))+/, lineBreaks: true},
-      },
-    })
+    moo.states(states())
+  })
+
+  benchmark('moo.compileStates, cached', () => {
+    moo.states(states(), {cache: true})
+  })
+
+  const json = moo.serialize(moo.states(states()))
+  benchmark('moo.deserialize', () => {
+    moo.deserialize(json)
   })
 
 })
@@ -87,6 +104,203 @@ suite('keywords', () => {
     while (tok = lexer.next()) { count++ }
   })
 
+  const skipping = moo.compile({
+    name: {match: /[a-z]+/, keywords: moo.keywords({cowword: keywords})},
+    space: {match: /\s+/, lineBreaks: true, skip: true},
+  })
+  benchmark('🐮 skip spaces', () => {
+    skipping.reset(source)
+    var count = 0
+    while (tok = skipping.next()) { count++ }
+  })
+
+})
+
+
+suite('rule count', () => {
+
+  // Only the last two rules ever match, so every token has to get past all
+  // the others first.
+  var source = ''
+  for (var i = 2000; i--; ) {
+    source += randomChoice(['moo', 'cow', 'grass', 'udder']) + ' '
+  }
+
+  for (const count of [10, 40, 80, 160, 320]) {
+    const rules = {}
+    for (var i = 0; i < count; i++) {
+      rules['rule' + i] = new RegExp('x' + i + '_[0-9]+')
+    }
+    rules.word = /[a-z]+/
+    rules.space = / +/
+    const lexer = moo.compile(rules)
+    const dispatchLexer = moo.compile(rules, {dispatch: true})
+
+    benchmark(`🐮 ${count} rules`, () => {
+      lexer.reset(source)
+      var count = 0
+      while (tok = lexer.next()) { count++ }
+      if (count !== 4000) throw 'fail'
+    })
+
+    benchmark(`🐮 ${count} rules, dispatch`, () => {
+      dispatchLexer.reset(source)
+      var count = 0
+      while (tok = dispatchLexer.next()) { count++ }
+      if (count !== 4000) throw 'fail'
+    })
+  }
+
+})
+
+
+suite('operators', () => {
+
+  const ops = ['==', '!=', '<=', '>=', '<<=', '>>=', '**=', '//=', '->', '+=',
+               '-=', '*', '/', '+', '-', '<', '>', '=', '(', ')']
+  var source = ''
+  for (var i = 2000; i--; ) {
+    source += randomChoice(ops) + 'x'
+  }
+
+  const lexer = moo.compile({
+    op: ops,
+    name: /[a-z]+/,
+  })
+  benchmark('🐮 literals first', () => {
+    lexer.reset(source)
+    var count = 0
+    while (tok = lexer.next()) { count++ }
+    if (count !== 4000) throw 'fail'
+  })
+
+  const regexLexer = moo.compile({
+    name: /[a-z]+/,
+    op: ops,
+  })
+  benchmark('🐮 literals after a RegExp', () => {
+    regexLexer.reset(source)
+    var count = 0
+    while (tok = regexLexer.next()) { count++ }
+    if (count !== 4000) throw 'fail'
+  })
+
+})
+
+
+suite('literal sets', () => {
+
+  // The `tagged` rule could start with any letter, so the words have to go in
+  // the RegExp.
+  for (const size of [10, 100, 1000, 10000]) {
+    const seen = Object.create(null)
+    const words = []
+    while (words.length < size) {
+      var word = ''
+      for (var i = 2 + Math.floor(Math.random() * 6); i--; ) {
+        word += randomChoice('abcdefghijklmnopqrstuvwxyz'.split(''))
+      }
+      if (seen[word]) continue
+      seen[word] = true
+      words.push(word)
+    }
+    const rules = {
+      tagged: /[a-z]+[0-9]+/,
+      word: words,
+      space: / +/,
+    }
+    var source = ''
+    for (var i = 2000; i--; ) {
+      source += randomChoice(words) + ' '
+    }
+
+    benchmark(`🐮 compile ${size} literals`, () => {
+      moo.compile(rules)
+    })
+
+    const lexer = moo.compile(rules)
+    benchmark(`🐮 lex ${size} literals`, () => {
+      lexer.reset(source)
+      var count = 0
+      while (tok = lexer.next()) { count++ }
+      if (count !== 4000) throw 'fail'
+    })
+  }
+
+})
+
+
+suite('position tracking', () => {
+
+  const pythonFile = fs.readFileSync('test/kurt.py', 'utf-8')
+  const rules = {
+    word: /\w+/,
+    space: {match: /\s+/, lineBreaks: true},
+    comment: /#.*/,
+    string: {match: /"""[^]*?"""|"(?:\\.|[^"\\\n])*"|'(?:\\.|[^'\\\n])*'/, lineBreaks: true},
+    other: /./,
+  }
+  for (const level of ['full', 'offset', 'none']) {
+    const lexer = moo.compile(rules, {positionTracking: level})
+    benchmark(`🐮 ${level}`, () => {
+      lexer.reset(pythonFile)
+      while (tok = lexer.next()) {}
+    })
+  }
+
+})
+
+
+suite('error recovery', () => {
+
+  const rules = {
+    word: /[a-z]+/,
+    number: /[0-9]+/,
+    space: {match: /\s+/, lineBreaks: true},
+  }
+  const input = 'cow 123 $$$$$$$$ moo\n'.repeat(5000)
+  for (const mode of ['char', 'resync']) {
+    const lexer = moo.compile(rules, {errorRecovery: mode})
+    benchmark(`🐮 ${mode}`, () => {
+      lexer.reset(input)
+      while (lexer.next()) {}
+    })
+  }
+
+  // formatting every error, in a file with lots of them
+  const lexer = moo.compile(rules, {errorRecovery: 'resync'})
+  lexer.reset(input)
+  while (lexer.next()) {}
+  const errors = lexer.errors
+  benchmark('🐮 formatError', () => {
+    for (const error of errors) lexer.formatError(error, 'invalid syntax')
+  })
+
+})
+
+
+suite('save/restore', () => {
+
+  // backtracking over every token, inside deeply nested states
+  const lexer = moo.states({
+    main: {
+      open: {match: '{', push: 'main'},
+      close: {match: '}', pop: 1},
+      word: /[a-z]+/,
+      space: / +/,
+    },
+  })
+  const input = '{'.repeat(200) + 'cow moo '.repeat(2000) + '}'.repeat(200)
+  benchmark('🐮 save() and restore()', () => {
+    lexer.reset(input)
+    let tok
+    do {
+      const info = lexer.save()
+      lexer.next()
+      lexer.restore(info)
+    } while (tok = lexer.next())
+  })
+
 })
 
 
@@ -112,6 +326,48 @@ suite('json', () => {
     if (count !== jsonCount) { throw 'fail' }
   })
 
+  const saved = JSON.parse(moo.serialize(jsonLexer))
+  saved.options.codegen = true
+  const jsonGenerated = moo.deserialize(saved)
+  benchmark('🐮 codegen', function() {
+    jsonGenerated.reset(jsonFile)
+    var count = 0
+    while (tok = jsonGenerated.next()) { count++ }
+    if (count !== jsonCount) { throw 'fail' }
+  })
+
+  const profiled = moo.deserialize(Object.assign({}, saved, {
+    options: Object.assign({}, saved.options, {codegen: false, profile: true}),
+  }))
+  benchmark('🐮 profile', function() {
+    profiled.reset(jsonFile)
+    var count = 0
+    while (tok = profiled.next()) { count++ }
+    if (count !== jsonCount) { throw 'fail' }
+  })
+
+  saved.options.reuseTokens = true
+  const jsonReused = moo.deserialize(saved)
+  benchmark('🐮 codegen, reuseTokens', function() {
+    jsonReused.reset(jsonFile)
+    var count = 0
+    for (let tok of jsonReused) { count++ }
+    if (count !== jsonCount) { throw 'fail' }
+  })
+
+  benchmark('🐮 for…of', function() {
+    jsonLexer.reset(jsonFile)
+    var count = 0
+    for (let tok of jsonLexer) { count++ }
+    if (count !== jsonCount) { throw 'fail' }
+  })
+
+  benchmark('🐮 reduce', function() {
+    jsonLexer.reset(jsonFile)
+    var count = jsonLexer.reduce(count => count + 1, 0)
+    if (count !== jsonCount) { throw 'fail' }
+  })
+
   const jsonChev = chevrotainFromMoo(jsonLexer)
   benchmark('chevrotain', function() {
     let count = jsonChev.tokenize(jsonFile).tokens.length
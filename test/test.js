@@ -108,7 +108,9 @@ describe('compiler', () => {
         'lol',
       ],
     })
-    expect(lexer.groups.length).toBe(3)
+    // 'lol' doesn't need the RegExp
+    expect(lexer.groups.length).toBe(2)
+    expect(lexer.reset('lol').next()).toMatchObject({type: 'op', value: 'lol'})
     expect(lexer.reset('string').next()).toMatchObject({type: 'op', value: 'string'})
     expect(lexer.reset('regexp').next()).toMatchObject({type: 'op', value: 'regexp'})
     expect(lexer.reset('something').next()).toMatchObject({type: 'op', value: 'something'})
@@ -145,6 +147,27 @@ describe('compiler', () => {
 
 })
 
+describe('many rules', () => {
+
+  test('finds the rule which matched', () => {
+    const rules = {}
+    for (var i = 0; i < 100; i++) {
+      rules['rule' + i] = new RegExp('x' + i + '_')
+    }
+    rules.space = / +/
+    const lexer = compile(rules)
+    expect(lexer.blocks.length).toBe(10)
+    const input = []
+    for (var i = 99; i >= 0; i -= 7) {
+      input.push('x' + i + '_')
+    }
+    lexer.reset(input.join(' '))
+    const types = lexAll(lexer).filter(t => t.type !== 'space').map(t => t.type)
+    expect(types).toEqual(input.map(x => 'rule' + x.slice(1, -1)))
+  })
+
+})
+
 describe('compiles literals', () => {
 
   test('escapes strings', () => {
@@ -185,6 +208,85 @@ describe('compiles literals', () => {
     expect(lexer.next()).toMatchObject({value: 'moo'})
   })
 
+  // (enough words that it's worth sharing their prefixes)
+  const filler = Array.from({length: 100}, (_, i) => 'w' + i)
+
+  test('shares prefixes between lots of literals in the RegExp', () => {
+    let lexer = moo.compile({
+      word: /[a-z]+|[<=>]+x/,
+      op: ['>', '>=', '>>', '>>=', '<', '=>'].concat(filler),
+    })
+    expect(lexer.re.source).toContain('>(?:>=?|=)?')
+    expect(lexer.re.source).toContain('w(?:1(?:0|1|2|3|4|5|6|7|8|9)?|2')
+    lexer.reset('a>>=>>>=<=>b')
+    expect(lexAll(lexer).map(t => t.text)).toEqual(
+      ['a', '>>=', '>>', '>=', '<', '=>', 'b'])
+  })
+
+  test('lists a few literals in the RegExp', () => {
+    let lexer = moo.compile({
+      word: /[a-z]+|[<=>]+x/,
+      op: ['>', '>=', '>>', '>>=', '<', '=>'],
+    })
+    expect(lexer.re.source).toContain('(?:(?:>>=))|(?:(?:>=))|(?:(?:>>))|(?:(?:=>))|(?:(?:>))|(?:(?:<))')
+    lexer.reset('a>>=>>>=<=>b')
+    expect(lexAll(lexer).map(t => t.text)).toEqual(
+      ['a', '>>=', '>>', '>=', '<', '=>', 'b'])
+  })
+
+  test('keeps surrogate pairs together', () => {
+    let lexer = moo.compile({
+      word: /[^ ]+x/u,
+      emoji: ['😀', '😁', '😀😀'].concat(filler),
+      space: / +/u,
+    })
+    expect(lexer.re.source).toContain('😀(?:😀)?')
+  })
+
+  test('matches leading literals without the RegExp', () => {
+    let lexer = moo.compile({
+      op: ['==', '=', '=>'],
+      arrow: '->',
+      word: /[a-z]+/,
+      minus: /-/,
+    })
+    expect(lexer.groups.map(g => g.defaultType)).toEqual(['word', 'minus'])
+    lexer.reset('a==b=c=>d->e-f')
+    expect(lexAll(lexer).map(t => t.text)).toEqual(
+      ['a', '==', 'b', '=', 'c', '=>', 'd', '->', 'e', '-', 'f'])
+  })
+
+  test('keeps rule order in the trie', () => {
+    let lexer = moo.compile({
+      a: 'ab',
+      b: ['abcd', 'a'],
+      c: 'cd',
+    })
+    lexer.reset('abcdacd')
+    expect(lexAll(lexer).map(t => t.type + ':' + t.text)).toEqual(
+      ['a:ab', 'c:cd', 'b:a', 'c:cd'])
+  })
+
+  test('matches later literals without the RegExp if nothing else could', () => {
+    let lexer = moo.compile({
+      word: /[a-z]+(?:-[a-z]+)*/,
+      space: {match: /\s+/, lineBreaks: true},
+      op: ['+=', '+', '-', 'if'],
+      dot: '.',
+    })
+    expect(Object.keys(lexer.fast)).toEqual(['45', '46'])
+    expect(Object.keys(lexer.trie)).toEqual(['43'])
+    expect(lexer.groups.map(g => g.defaultType)).toEqual(['word', 'space', 'op'])
+    lexer.reset('if a-b += c.d-e')
+    expect(lexAll(lexer).map(t => t.text)).toEqual(
+      ['if', ' ', 'a-b', ' ', '+=', ' ', 'c', '.', 'd-e'])
+  })
+
+  test('checks states of literal rules', () => {
+    expect(() => moo.states({main: {arrow: {match: '=>', next: 'missing'}}}))
+    .toThrow("Missing state 'missing' (in token 'arrow' of state 'main')")
+  })
+
 })
 
 describe('fallback tokens', () => {
@@ -295,14 +397,16 @@ describe('fallback tokens', () => {
     expect(() => lexer.next()).toThrow('invalid syntax')
   })
 
-  test('disables fast single-character matching', () => {
+  test('keeps fast single-character matches in the RegExp', () => {
     const lexer = moo.compile({
       fast: '.',
+      arrow: '->',
       text: moo.fallback,
     })
-    lexer.reset('foo.bar')
-    expect(Array.from(lexer).map(x => x.value)).toEqual(['foo', '.', 'bar'])
-    expect(lexer.fast).toEqual({})
+    lexer.reset('foo.bar->.baz')
+    expect(Array.from(lexer).map(x => x.value)).toEqual(['foo', '.', 'bar', '->', '.', 'baz'])
+    expect(Object.keys(lexer.fast)).toEqual(['46'])
+    expect(lexer.groups.map(g => g.defaultType)).toEqual(['fast', 'arrow'])
   })
 
 })
@@ -574,270 +678,1583 @@ describe('lexer', () => {
 })
 
 
-describe('Lexer#has', () => {
+describe('lexer options', () => {
 
-  const basicLexer = compile({
-    keyword: 'foo',
-    identifier: /[a-z]+/,
-    error: moo.error
+  test('rejects unknown options', () => {
+    expect(() => compile({word: /[a-z]+/}, {lazyTxet: true})).toThrow("Unknown lexer option 'lazyTxet'")
   })
 
-  test('supports has()', () => {
-    expect(basicLexer.has('identifier')).toBe(true)
+  test('can be passed to states() without a start state', () => {
+    const lexer = moo.states({main: {word: /[a-z]+/}}, {lazyText: true})
+    expect(lexer.startState).toBe('main')
+    expect(lexer.options.lazyText).toBe(true)
   })
 
-  test('works with literals', () => {
-    expect(basicLexer.has('keyword')).toBe(true)
+  test('are kept by clones', () => {
+    const lexer = compile({word: /[a-z]+/}, {lazyText: true})
+    expect(lexer.clone().options).toBe(lexer.options)
   })
 
-  test('finds the error token', () => {
-    expect(basicLexer.has('error')).toBe(true)
+})
+
+
+describe('cache', () => {
+
+  beforeEach(() => {
+    moo.cache.clear()
+  })
+
+  test('returns clones of the lexer for a spec it has seen', () => {
+    const spec = () => ({word: /[a-z]+/, space: / +/, op: ['+', '-']})
+    const a = moo.compile(spec(), {cache: true})
+    const b = moo.compile(spec(), {cache: true})
+    expect(a).not.toBe(b)
+    expect(a.states).toBe(b.states)
+    expect(moo.cache).toMatchObject({hits: 1, misses: 1, entries: 1})
+    a.reset('a + b')
+    b.reset('c')
+    expect(lexAll(a).map(t => t.text)).toEqual(['a', ' ', '+', ' ', 'b'])
+  })
+
+  test('tells specs apart', () => {
+    moo.compile({word: /[a-z]+/}, {cache: true})
+    moo.compile({word: /[a-z]+/u}, {cache: true})
+    moo.compile({word: '[a-z]+'}, {cache: true})
+    moo.compile({name: /[a-z]+/}, {cache: true})
+    moo.compile({word: /[a-z]+/}, {cache: true, lazyText: true})
+    moo.states({main: {word: /[a-z]+/}}, {cache: true})
+    expect(moo.cache).toMatchObject({hits: 0, misses: 6})
+  })
+
+  test('compares keyword transforms by their keywords', () => {
+    const spec = () => ({word: {match: /[a-z]+/, type: moo.keywords({kw: ['if', 'else']})}})
+    moo.compile(spec(), {cache: true})
+    moo.compile(spec(), {cache: true})
+    const transform = x => x
+    moo.compile({word: {match: /[a-z]+/, type: transform}}, {cache: true})
+    moo.compile({word: {match: /[a-z]+/, type: x => x}}, {cache: true})
+    moo.compile({word: {match: /[a-z]+/, type: transform}}, {cache: true})
+    expect(moo.cache).toMatchObject({hits: 2, misses: 3})
+  })
+
+  test('caches states() before $all is removed', () => {
+    const spec = () => ({main: {word: /[a-z]+/}, $all: {space: / +/}})
+    moo.states(spec(), {cache: true})
+    const lexer = moo.states(spec(), {cache: true})
+    expect(moo.cache.hits).toBe(1)
+    lexer.reset('a b')
+    expect(lexAll(lexer).map(t => t.type)).toEqual(['word', 'space', 'word'])
+  })
+
+  test('evicts the least recently used lexer', () => {
+    const cache = moo.cache
+    const maxEntries = cache.maxEntries
+    cache.maxEntries = 2
+    try {
+      moo.compile({a: 'a'}, {cache: true})
+      moo.compile({b: 'b'}, {cache: true})
+      moo.compile({a: 'a'}, {cache: true})
+      moo.compile({c: 'c'}, {cache: true})
+      expect(cache).toMatchObject({entries: 2, evictions: 1})
+      moo.compile({a: 'a'}, {cache: true})
+      expect(cache.hits).toBe(2)
+      moo.compile({b: 'b'}, {cache: true})
+      expect(cache.misses).toBe(4)
+    } finally {
+      cache.maxEntries = maxEntries
+    }
   })
 
-  test('returns true even for nonexistent junk', () => {
-    expect(basicLexer.has('random')).toBe(true)
+  test('is bounded by size', () => {
+    const cache = moo.cache
+    const maxSize = cache.maxSize
+    try {
+      moo.compile({a: 'a'}, {cache: true})
+      cache.maxSize = cache.size + 10
+      moo.compile({b: 'b'}, {cache: true})
+      expect(cache.size).toBeLessThanOrEqual(cache.maxSize)
+      expect(cache.evictions).toBe(1)
+      moo.compile({big: 'x'.repeat(100)}, {cache: true})
+      expect(cache.entries).toBe(1)
+    } finally {
+      cache.maxSize = maxSize
+    }
   })
 
-  const keywordLexer = compile({
-    identifier: {
-      match: /[a-zA-Z]+/,
-      type: moo.keywords({
-        'kw-class': 'class',
-        'kw-def': 'def',
-        'kw-if': 'if',
-      }),
+})
+
+
+describe('serialize', () => {
+
+  function unquote(x) {
+    return x.slice(1, -1)
+  }
+
+  const spec = () => ({
+    main: {
+      string: {match: /"[^"]*"/, value: unquote},
+      word: {match: /[a-z]+/, type: moo.keywords({kw: ['if', 'then']})},
+      op: ['+=', '+', '-', '=='],
+      lparen: {match: '(', push: 'main'},
+      rparen: {match: ')', pop: 1},
+      space: {match: /\s+/, lineBreaks: true},
     },
   })
+  const input = 'if (a += "b c")\nthen -(d == e)'
 
-  test("returns true even for keywords", () => {
-    expect(keywordLexer.has('kw-class')).toBe(true)
+  test('round-trips a lexer', () => {
+    const lexer = moo.states(spec())
+    const json = moo.serialize(lexer)
+    expect(typeof json).toBe('string')
+    const loaded = moo.deserialize(json, {unquote})
+    expect(loaded.has('kw')).toBe(true)
+    expect(loaded.has('nope')).toBe(false)
+    expect(lexAll(loaded.reset(input))).toEqual(lexAll(lexer.reset(input)))
   })
 
-  // Example from the readme.
-  const statefulLexer = moo.states({
-    main: {
-      strstart: {match: '`', push: 'lit'},
-      ident:    /\w+/,
-      lbrace:   {match: '{', push: 'main'},
-      rbrace:   {match: '}', pop: true},
-      colon:    ':',
-      space:    {match: /\s+/, lineBreaks: true},
-      mainErr:  moo.error,
-    },
-    lit: {
-      interp:   {match: '${', push: 'main'},
-      escape:   /\\./,
-      strend:   {match: '`', pop: true},
-      const:    {match: /(?:[^$`]|\$(?!\{))+/, lineBreaks: true},
-			litErr:   moo.error,
-    },
+  test('keeps lexer options', () => {
+    const lexer = moo.states(spec(), {dispatch: true, lazyText: true})
+    const loaded = moo.deserialize(moo.serialize(lexer), {unquote})
+    expect(loaded.options).toMatchObject({dispatch: true, lazyText: true})
+    expect(loaded.dispatch.length).toBe(128)
+    expect(lexAll(loaded.reset(input)).map(t => t.text)).toEqual(
+      lexAll(lexer.reset(input)).map(t => t.text))
   })
 
-  test('works with multiple states - for first state', () => {
-    expect(statefulLexer.has('ident')).toEqual(true)
+  test('names inline functions after their rule', () => {
+    const lexer = moo.compile({
+      a: {match: 'a', value: x => x + '!'},
+      b: [
+        {match: 'b', value: x => x + '?'},
+        {match: 'c', value: x => x + '.'},
+      ],
+    })
+    const json = moo.serialize(lexer)
+    expect(() => moo.deserialize(json)).toThrow("Missing function 'a.value'")
+    const loaded = moo.deserialize(json, {
+      'a.value': x => x + '!',
+      'b.value': x => x + '?',
+      'b.value2': x => x + '.',
+    })
+    expect(lexAll(loaded.reset('abc')).map(t => t.value)).toEqual(['a!', 'b?', 'c.'])
   })
 
-  test('works with multiple states - for second state', () => {
-    expect(statefulLexer.has('interp')).toEqual(true)
+  test('round-trips the python lexer', () => {
+    const json = moo.serialize(python.lexer)
+    expect(Object.keys(JSON.parse(json).groups.filter(g => g.value).reduce((names, g) => {
+      names[g.value.$function] = true
+      return names
+    }, {}))).toEqual(['STRING.value', 'STRING.value2', 'STRING.value3'])
   })
 
-  test('works with error tokens - for first state', () => {
-    expect(statefulLexer.has('mainErr')).toEqual(true)
+  test('uses the names it is given for functions', () => {
+    const lexer = moo.compile({
+      a: {match: 'a', value: x => x + '!'},
+      b: {match: 'b', value: x => x + '?'},
+    })
+    const functions = {bang: lexer.fast[97].value, huh: lexer.fast[98].value}
+    const json = moo.serialize(lexer, functions)
+    expect(() => moo.deserialize(json)).toThrow("Missing function 'bang'")
+    const loaded = moo.deserialize(json, functions)
+    expect(lexAll(loaded.reset('ab')).map(t => t.value)).toEqual(['a!', 'b?'])
   })
 
-  test('works with error tokens - for second state', () => {
-    expect(statefulLexer.has('litErr')).toEqual(true)
+  test('rejects other JSON', () => {
+    expect(() => moo.deserialize('{}')).toThrow('Not a serialized lexer')
   })
 
 })
 
 
-describe('stateful lexer', () => {
+describe('position tracking', () => {
 
-  const statefulLexer = moo.states({
-    start: {
-      word: /\w+/,
-      eq: {match: '=', next: 'ab'},
-      myError: moo.error,
-    },
-    ab: {
-      a: 'a',
-      b: 'b',
-      semi: {match: ';', next: 'start'},
-    },
+  const rules = {
+    word: /[a-z]+/,
+    space: {match: /\s+/, lineBreaks: true},
+  }
+
+  test('can skip lines and columns', () => {
+    for (const codegen of [false, true]) {
+      const lexer = compile(rules, {positionTracking: 'offset', codegen})
+      lexer.reset('ab\n cd')
+      expect(lexer.line).toBe(undefined)
+      const tokens = lexAll(lexer)
+      expect(tokens.map(t => t.offset)).toEqual([0, 2, 4])
+      expect(tokens[1]).toMatchObject({text: '\n ', line: undefined, col: undefined, lineBreaks: undefined})
+    }
   })
 
-  test('switches states', () => {
-    statefulLexer.reset('one=ab;two=')
-    expect(lexAll(statefulLexer).map(({type, value}) => [type, value])).toEqual([
-      ['word', 'one'],
-      ['eq', '='],
-      ['a', 'a'],
-      ['b', 'b'],
-      ['semi', ';'],
-      ['word', 'two'],
-      ['eq', '='],
-    ])
+  test('can skip offsets too', () => {
+    for (const codegen of [false, true]) {
+      const lexer = compile(rules, {positionTracking: 'none', codegen})
+      const tokens = lexAll(lexer.reset('ab\n cd'))
+      expect(tokens.map(t => t.text)).toEqual(['ab', '\n ', 'cd'])
+      expect(tokens.map(t => t.offset)).toEqual([undefined, undefined, undefined])
+    }
   })
 
-  test('supports errors', () => {
-    statefulLexer.reset('foo!')
-    expect(lexAll(statefulLexer).map(({type, value}) => [type, value])).toEqual([
-      ['word', 'foo'],
-      ['myError', '!'],
-    ])
+  test('still formats errors', () => {
+    const lexer = compile(rules, {positionTracking: 'offset'})
+    lexer.reset('ab\n c!')
+    expect(() => lexAll(lexer)).toThrow('invalid syntax at line 2 col 3')
   })
 
-  const parens = moo.states({
-    start: {
-      word: /\w+/,
-      lpar: {match: '(', push: 'inner'},
-      rpar: ')',
-    },
-    inner: {
-      thing: /\w+/,
-      lpar: {match: '(', push: 'inner'},
-      rpar: {match: ')', pop: true},
-    },
+  test('looks up positions on demand', () => {
+    const lexer = compile(rules, {positionTracking: 'offset'})
+    lexer.reset('ab\n cd\n\nef')
+    expect(lexer.positionAt(0)).toEqual({line: 1, col: 1})
+    expect(lexer.positionAt(2)).toEqual({line: 1, col: 3})
+    expect(lexer.positionAt(3)).toEqual({line: 2, col: 1})
+    expect(lexer.positionAt(7)).toEqual({line: 3, col: 1})
+    expect(lexer.positionAt(10)).toEqual({line: 4, col: 3})
+    expect(() => lexer.positionAt(11)).toThrow('Offset 11 is outside the input')
+    for (const tok of lexAll(compile(rules).reset('ab\n cd\n\nef'))) {
+      expect(lexer.positionAt(tok.offset)).toEqual({line: tok.line, col: tok.col})
+    }
   })
 
-  test('maintains a stack', () => {
-    parens.reset('a(b(c)d)e')
-    expect(lexAll(parens).map(({type, value}) => [type, value])).toEqual([
-      ['word', 'a'],
-      ['lpar', '('],
-      ['thing', 'b'],
-      ['lpar', '('],
-      ['thing', 'c'],
-      ['rpar', ')'],
-      ['thing', 'd'],
-      ['rpar', ')'],
-      ['word', 'e'],
-    ])
+  test('looks up positions after reset() with info', () => {
+    const lexer = compile(rules)
+    lexer.reset('ab\ncd', {line: 3, col: 5, state: lexer.startState})
+    expect(lexer.positionAt(1)).toEqual({line: 3, col: 6})
+    expect(lexer.positionAt(4)).toEqual({line: 4, col: 2})
   })
 
-  test('allows popping too many times', () => {
-    parens.reset(')e')
-    expect(lexAll(parens).map(({type, value}) => [type, value])).toEqual([
-      ['rpar', ')'],
-      ['word', 'e'],
-    ])
+  test('looks up positions of input which was fed', () => {
+    const lexer = compile(rules, {positionTracking: 'offset'})
+    lexer.reset()
+    lexer.feed('ab\ncd ')
+    lexer.feed('e\nf')
+    lexer.feed('gh ')
+    expect(lexer.positionAt(4)).toEqual({line: 2, col: 2})
+    expect(lexer.positionAt(10)).toEqual({line: 3, col: 3})
   })
 
-  test('resets state', () => {
-    statefulLexer.reset('one=a')
-    expect(statefulLexer.state).toBe('start')
-    expect(lexAll(statefulLexer).map(({type, value}) => [type, value])).toEqual([
-      ['word', 'one'],
-      ['eq', '='],
-      ['a', 'a'],
-    ])
-    expect(statefulLexer.state).toBe('ab')
-    statefulLexer.reset('one=ab;two=')
-    expect(statefulLexer.state).toBe('start')
-  })
+  test("doesn't remember fed lines unless asked to", () => {
+    const lexer = compile(rules, {positionTracking: 'offset'})
+    lexer.reset()
+    for (let i = 0; i < 1000; i++) lexer.feed('ab cd\n')
+    expect(lexer.lineStarts).toBe(null)
+    expect(lexer.positionAt(6 * 999 + 4)).toEqual({line: 1000, col: 5})
+    expect(() => lexer.positionAt(6)).toThrow('Offset 6 is on a line which feed() has dropped')
 
-  test('lexes interpolation example', () => {
-    let lexer = moo.states({
-      main: {
-        strstart: {match: '`', push: 'lit'},
-        ident:    /\w+/,
-        lbrace:   {match: '{', push: 'main'},
-        rbrace:   {match: '}', pop: true},
-        colon:    ':',
-        space:    {match: /\s+/, lineBreaks: true},
-      },
-      lit: {
-        interp:   {match: '${', push: 'main'},
-        escape:   /\\./,
-        strend:   {match: '`', pop: true},
-        const:    {match: /(?:[^$`]|\$(?!\{))+/, lineBreaks: true},
-      },
-    }).reset('`a${{c: d}}e`')
-    expect(lexAll(lexer).map(t => t.type).join(' ')).toBe('strstart const interp lbrace ident colon space ident rbrace rbrace const strend')
+    // once positionAt() has been used, keep the lines we drop
+    lexer.feed('ef\n')
+    lexer.feed('gh')
+    expect(lexer.positionAt(6 * 999 + 4)).toEqual({line: 1000, col: 5})
+    expect(lexer.lineStarts.length).toBeLessThan(5)
   })
 
-  test('warns for non-existent states', () => {
-    expect(() => moo.states({start: {bar: {match: 'bar', next: 'foo'}}})).toThrow("Missing state 'foo'")
-    expect(() => moo.states({start: {bar: {match: 'bar', push: 'foo'}}})).toThrow("Missing state 'foo'")
-    expect(() => moo.states({start: {foo: 'fish', bar: {match: 'bar', push: 'foo'}}})).toThrow("Missing state 'foo'")
+  test('keeps offsets up to date when lexing incrementally', () => {
+    const lexer = compile(rules, {positionTracking: 'offset'})
+    const doc = lexer.incremental('ab cd\nef', 1)
+    doc.edit(0, 2, 'xyz')
+    expect(doc.tokens.map(t => t.offset)).toEqual([0, 3, 4, 6, 7])
   })
 
-  test('warns for non-boolean pop', () => {
-    expect(() => moo.states({start: {bar: {match: 'bar', pop: 'cow'}}})).toThrow("pop must be 1 (in token 'bar' of state 'start')")
-    expect(() => moo.states({start: {bar: {match: 'bar', pop: 2}}})).toThrow("pop must be 1 (in token 'bar' of state 'start')")
-    expect(() => moo.states({start: {bar: {match: 'bar', pop: true}}})).not.toThrow()
-    expect(() => moo.states({start: {bar: {match: 'bar', pop: 1}}})).not.toThrow()
-    expect(() => moo.states({start: {bar: {match: 'bar', pop: false}}})).not.toThrow()
-    expect(() => moo.states({start: {bar: {match: 'bar', pop: 0}}})).not.toThrow()
+  test('rejects other levels', () => {
+    expect(() => compile(rules, {positionTracking: 'lines'}))
+    .toThrow("positionTracking must be 'full', 'offset' or 'none' (not 'lines')")
   })
 
 })
 
 
-describe('line numbers', () => {
+describe('skip', () => {
 
-  var testLexer = compile({
-    WS: / +/,
+  const rules = () => ({
+    space: {match: /\s+/, lineBreaks: true, skip: true},
+    comment: {match: /#.*/, skip: true, value: () => { throw new Error('value') }},
     word: /[a-z]+/,
-    NL: { match: /\n/, lineBreaks: true },
   })
 
-  test('counts line numbers', () => {
-    var tokens = lexAll(testLexer.reset('cow\nfarm\ngrass'))
-    expect(tokens.map(t => t.value)).toEqual(['cow', '\n', 'farm', '\n', 'grass'])
-    expect(tokens.map(t => t.lineBreaks)).toEqual([0, 1, 0, 1, 0])
-    expect(tokens.map(t => t.line)).toEqual([1, 1, 2, 2, 3])
-    expect(tokens.map(t => t.col)).toEqual([1, 4, 1, 5, 1])
+  test('leaves out skipped tokens', () => {
+    for (const codegen of [false, true]) {
+      const lexer = compile(rules(), {codegen})
+      lexer.reset('ab # cd\n  ef')
+      expect(lexAll(lexer).map(t => [t.value, t.offset, t.line, t.col])).toEqual([
+        ['ab', 0, 1, 1],
+        ['ef', 10, 2, 3],
+      ])
+    }
   })
 
-  test('tracks columns', () => {
-    var lexer = compile({
-      WS: / +/,
-      thing: { match: /[a-z\n]+/, lineBreaks: true },
-    })
-    lexer.reset('pie cheese\nsalad what\n ')
-    expect(lexer.next()).toMatchObject({ value: 'pie', col: 1 })
-    expect(lexer.next()).toMatchObject({ value: ' ', col: 4 })
-    expect(lexer.next()).toMatchObject({ value: 'cheese\nsalad', col: 5, line: 1 })
-    expect(lexer.next()).toMatchObject({ value: ' ', col: 6, line: 2 })
-    expect(lexer.next()).toMatchObject({ value: 'what\n', col: 7, line: 2 })
-    expect(lexer.next()).toMatchObject({ value: ' ', col: 1, line: 3 })
+  test('leaves skipped tokens out of tapes', () => {
+    const tape = compile(rules()).tokenizeAll('ab # cd\n  ef')
+    expect(tape.length).toBe(2)
+    expect(tape.offsets[1]).toBe(10)
+  })
+
+  test('still switches states', () => {
+    for (const codegen of [false, true]) {
+      const lexer = moo.states({
+        main: {
+          open: {match: '/*', push: 'comment', skip: true},
+          word: /[a-z]+/,
+        },
+        comment: {
+          close: {match: '*/', pop: 1, skip: true},
+          text: {match: /[^*]+|\*/, lineBreaks: true, skip: true},
+        },
+      }, {codegen})
+      lexer.reset('ab/* cd */ef/**//**/gh')
+      expect(lexAll(lexer).map(t => t.value)).toEqual(['ab', 'ef', 'gh'])
+    }
   })
 
-  test('tries to warn if rule matches \\n', () => {
-    expect(() => compile({whitespace: /\s+/})).toThrow()
-    expect(() => compile({multiline: /q[^]*/})).not.toThrow()
+  test('works when streaming', () => {
+    const lexer = compile(rules())
+    lexer.reset()
+    const tokens = lexer.feed('ab  ').concat(lexer.feed(' # c'), lexer.feed('d\nef'), lexer.end())
+    expect(tokens.map(t => t.value)).toEqual(['ab', 'ef'])
   })
 
-  test('resets line/col', () => {
-    var lexer = compile({
-      WS: / +/,
-      word: /[a-z]+/,
-      NL: { match: '\n', lineBreaks: true },
-    })
-    lexer.reset('potatoes\nsalad')
-    expect(lexer).toMatchObject({buffer: 'potatoes\nsalad', line: 1, col: 1})
-    lexAll(lexer)
-    expect(lexer).toMatchObject({line: 2, col: 6})
-    lexer.reset('cheesecake')
-    expect(lexer).toMatchObject({buffer: 'cheesecake', line: 1, col: 1})
+  test('keeps incremental lexing in step', () => {
+    const doc = compile(rules()).incremental('ab cd ef\n'.repeat(100))
+    const result = doc.edit(3, 1, 'x')
+    expect(result.removed).toBe(2)
+    expect(result.tokens.map(t => t.value)).toEqual(['ab', 'xd'])
   })
 
 })
 
 
-describe('save/restore', () => {
+describe('peek', () => {
 
-  const testLexer = compile({
-    word: /[a-z]+/,
-    NL: { match: '\n', lineBreaks: true },
+  const spec = () => ({
+    main: {
+      word: {match: /[a-z]+/, type: moo.keywords({kw: ['if']})},
+      lparen: {match: '(', push: 'paren'},
+      space: {match: /\s+/, lineBreaks: true, skip: true},
+    },
+    paren: {
+      number: /[0-9]+/,
+      rparen: {match: ')', pop: 1},
+    },
   })
 
-  test('can save info', () => {
-    testLexer.reset('one\ntwo')
-    lexAll(testLexer)
-    expect(testLexer.save()).toMatchObject({line: 2, col: 4})
+  test('rejects bad counts', () => {
+    const lexer = moo.states(spec())
+    lexer.reset('a b c')
+    for (const k of [0, -2, 1.5, NaN, '2']) {
+      expect(() => lexer.peek(k)).toThrow('peek() needs a whole number of tokens, 1 or more (not ' + k + ')')
+    }
+    expect(lexer.next().value).toBe('a')
+  })
+
+  test('looks ahead without lexing again', () => {
+    for (const codegen of [false, true]) {
+      const lexer = moo.states(spec(), {codegen})
+      lexer.reset('if (12)\nab')
+      expect(lexer.peek().value).toBe('if')
+      expect(lexer.peek(3).value).toBe('12')
+      expect(lexer.peek(2).value).toBe('(')
+      const first = lexer.next()
+      expect(first.value).toBe('if')
+      expect(lexer.peek(4)).toMatchObject({value: 'ab', line: 2, col: 1})
+      expect(lexer.peek(5)).toBe(undefined)
+      expect(lexAll(lexer).map(t => t.value)).toEqual(['(', '12', ')', 'ab'])
+    }
+  })
+
+  test('grows the buffer', () => {
+    const lexer = moo.states(spec())
+    let input = ''
+    for (var i = 0; i < 20; i++) input += 'a' + i.toString(36).replace(/[0-9]/g, 'x') + ' '
+    const expected = lexAll(lexer.reset(input)).map(t => t.value)
+    lexer.reset(input)
+    const tokens = [lexer.next(), lexer.next(), lexer.next()]
+    expect(lexer.peek(10).value).toBe(expected[12])
+    while (lexer.peek(2)) tokens.push(lexer.next())
+    tokens.push(...lexAll(lexer))
+    expect(tokens.map(t => t.value)).toEqual(expected)
+  })
+
+  test('saves the state before the peeked tokens', () => {
+    const lexer = moo.states(spec())
+    lexer.reset('ab (12)\ncd')
+    lexer.next()
+    lexer.next()
+    lexer.peek(3)
+    expect(lexer.state).toBe('main')
+    const info = lexer.save()
+    expect(info).toMatchObject({line: 1, col: 5, state: 'paren', offset: 4})
+    expect(info.stack.toArray()).toEqual(['main'])
+    lexer.next()
+    expect(lexer.save()).toMatchObject({line: 1, col: 7, state: 'paren'})
+  })
+
+  test('works with reuseTokens', () => {
+    const lexer = compile({word: /[a-z]+/, space: / +/}, {reuseTokens: true})
+    lexer.reset('ab cd')
+    expect(lexer.peek(3).value).toBe('cd')
+    expect(lexer.peek(1).value).toBe('ab')
+    expect(lexer.next().value).toBe('ab')
+  })
+
+  test('forgets peeked tokens on reset()', () => {
+    const lexer = moo.states(spec())
+    lexer.reset('ab cd').peek(2)
+    lexer.reset('ef')
+    expect(lexAll(lexer).map(t => t.value)).toEqual(['ef'])
+  })
+
+})
+
+
+describe('scan and reduce', () => {
+
+  const lexer = compile({
+    word: /[a-z]+/,
+    number: /[0-9]+/,
+    space: {match: /\s+/, lineBreaks: true},
+  })
+
+  test('scan() calls back with each token', () => {
+    const types = []
+    lexer.reset('ab 12\ncd')
+    lexer.scan(tok => { types.push(tok.type) })
+    expect(types).toEqual(['word', 'space', 'number', 'space', 'word'])
+    expect(lexer.next()).toBe(undefined)
+  })
+
+  test('scan() stops if the callback returns false', () => {
+    const values = []
+    lexer.reset('ab 12 cd')
+    lexer.scan(tok => {
+      if (tok.type === 'number') return false
+      values.push(tok.value)
+    })
+    expect(values).toEqual(['ab', ' '])
+    expect(lexer.next().value).toBe(' ')
+  })
+
+  test('reduce() folds the tokens', () => {
+    lexer.reset('ab 12\ncd 3')
+    const counts = lexer.reduce((counts, tok) => {
+      counts[tok.type] = (counts[tok.type] || 0) + 1
+      return counts
+    }, {})
+    expect(counts).toEqual({word: 2, number: 2, space: 3})
+    expect(lexer.reset('').reduce(x => x + 1, 0)).toBe(0)
+  })
+
+})
+
+
+describe('reuseTokens', () => {
+
+  const rules = {
+    word: {match: /[a-z]+/, type: moo.keywords({kw: ['if']})},
+    number: {match: /[0-9]+/, value: x => +x},
+    space: {match: /\s+/, lineBreaks: true},
+  }
+
+  test('returns the same token every time', () => {
+    for (const codegen of [false, true]) {
+      const lexer = compile(rules, {reuseTokens: true, codegen})
+      lexer.reset('if 12\nab')
+      const first = lexer.next()
+      expect(first).toMatchObject({type: 'kw', value: 'if', offset: 0, line: 1, col: 1})
+      expect(lexer.next()).toBe(first)
+      expect(lexer.next()).toBe(first)
+      expect(first).toMatchObject({type: 'number', value: 12, text: '12', offset: 3, line: 1, col: 4})
+      expect(lexer.next()).toBe(first)
+      expect(first).toMatchObject({type: 'space', lineBreaks: 1})
+      expect(lexer.next()).toBe(first)
+      expect(first).toMatchObject({type: 'word', value: 'ab', lineBreaks: 0, offset: 6, line: 2, col: 1})
+      expect(String(first)).toBe('ab')
+      expect(lexer.next()).toBe(undefined)
+    }
+  })
+
+  test('lexes the same tokens', () => {
+    const input = 'if 12\nab 3  if'
+    const expected = lexAll(compile(rules).reset(input))
+    const lexer = compile(rules, {reuseTokens: true})
+    const tokens = []
+    for (const tok of lexer.reset(input)) tokens.push(tok.clone())
+    expect(tokens).toEqual(expected)
+  })
+
+  test('can clone tokens', () => {
+    const lexer = compile(rules, {reuseTokens: true})
+    lexer.reset('ab 1')
+    const ab = lexer.next().clone()
+    lexer.next()
+    expect(ab).toMatchObject({type: 'word', value: 'ab', offset: 0})
+    expect(ab.clone()).toEqual(ab)
+    expect(ab.clone()).not.toBe(ab)
+  })
+
+  test('still keeps every token when streaming', () => {
+    const lexer = compile(rules, {reuseTokens: true})
+    lexer.reset()
+    const tokens = lexer.feed('ab 12 ').concat(lexer.end())
+    expect(tokens.map(t => t.value)).toEqual(['ab', ' ', 12, ' '])
+    const doc = lexer.incremental('ab 12')
+    expect(doc.tokens.map(t => t.value)).toEqual(['ab', ' ', 12])
+  })
+
+  test('throws with lazyText', () => {
+    expect(() => compile(rules, {reuseTokens: true, lazyText: true}))
+    .toThrow("reuseTokens can't be used with lazyText")
+  })
+
+})
+
+
+describe('profile', () => {
+
+  const spec = () => ({
+    main: {
+      word: /[a-z]+/,
+      space: / +/,
+      lparen: {match: '(', push: 'paren'},
+      arrow: '=>',
+    },
+    paren: {
+      digits: /[0-9]+/,
+      rparen: {match: ')', pop: 1},
+      comma: ',',
+    },
+  })
+
+  test('counts tokens for each state and rule', () => {
+    const lexer = moo.states(spec(), {profile: true})
+    lexer.reset('ab => (12,3) cd')
+    expect(lexAll(lexer).length).toBe(11)
+    const stats = lexer.stats()
+    expect(stats.states.main).toMatchObject({
+      tokens: 7,
+      chars: 10,
+      fast: 1,
+      trie: 1,
+      regex: 5,
+      pushes: 1,
+      pops: 0,
+    })
+    expect(stats.states.main.rules).toEqual({
+      word: {tokens: 2, chars: 4, fast: 0, trie: 0, regex: 2},
+      space: {tokens: 3, chars: 3, fast: 0, trie: 0, regex: 3},
+      arrow: {tokens: 1, chars: 2, fast: 0, trie: 1, regex: 0},
+      lparen: {tokens: 1, chars: 1, fast: 1, trie: 0, regex: 0},
+    })
+    expect(stats.states.paren).toMatchObject({tokens: 4, chars: 5, fast: 2, regex: 2, pushes: 0, pops: 1})
+    expect(stats.states.paren.regexTime).toBeGreaterThanOrEqual(0)
+  })
+
+  test('counts across resets, but not clones', () => {
+    const lexer = moo.states(spec(), {profile: true})
+    lexer.reset('ab')
+    lexAll(lexer)
+    lexer.reset('cd')
+    lexAll(lexer)
+    expect(lexer.stats().states.main.tokens).toBe(2)
+    expect(lexer.clone().stats()).toEqual({states: {}})
+  })
+
+  test('counts skipped tokens and tokenizeAll()', () => {
+    const rules = spec()
+    rules.main.space = {match: / +/, skip: true}
+    const lexer = moo.states(rules, {profile: true})
+    expect(lexer.tokenizeAll('ab cd').length).toBe(2)
+    expect(lexer.stats().states.main.rules.space).toMatchObject({tokens: 1, chars: 1})
+  })
+
+  test('gives the same tokens', () => {
+    const input = 'ab => (12,3) cd (4) e'
+    const lexer = moo.states(spec(), {profile: true, codegen: true})
+    lexer.reset(input)
+    const plain = moo.states(spec())
+    plain.reset(input)
+    expect(lexAll(lexer)).toEqual(lexAll(plain))
+  })
+
+  test('is needed for stats()', () => {
+    const lexer = moo.states(spec())
+    expect(() => lexer.stats()).toThrow("stats() needs the profile option")
+  })
+
+})
+
+
+describe('codegen', () => {
+
+  const spec = () => ({
+    main: {
+      string: {match: /"[^"]*"/, value: x => x.slice(1, -1)},
+      word: {match: /[a-z]+/, type: moo.keywords({kw: ['if', 'then']})},
+      op: ['+=', '+', '-', '=='],
+      lparen: {match: '(', push: 'main'},
+      rparen: {match: ')', pop: 1},
+      lbrace: {match: '{', next: 'text'},
+      space: {match: /\s+/, lineBreaks: true},
+    },
+    text: {
+      rbrace: {match: '}', next: 'main'},
+      text: moo.fallback,
+    },
+  })
+
+  test('generates a next() for each state', () => {
+    const lexer = moo.states(spec(), {codegen: true})
+    expect(typeof lexer.states.main.next).toBe('function')
+    expect(lexer.next).toBe(lexer.states.main.next)
+    lexer.reset('{')
+    lexer.next()
+    expect(lexer.next).toBe(lexer.states.text.next)
+  })
+
+  test('lexes the same tokens', () => {
+    const input = 'if (a += "b c")\nthen -(d == e) {some\ntext} x'
+    const lexer = moo.states(spec())
+    const generated = moo.states(spec(), {codegen: true})
+    expect(lexAll(generated.reset(input))).toEqual(lexAll(lexer.reset(input)))
+    expect(() => lexAll(generated.reset('a = b'))).toThrow('invalid syntax at line 1 col 3')
+  })
+
+  test('throws the same errors', () => {
+    const lexer = compile({word: /[a-z]+/, space: / +/}, {codegen: true})
+    lexer.reset('ab  c!d')
+    expect(() => lexAll(lexer)).toThrow('invalid syntax at line 1 col 6')
+  })
+
+  test('falls back when eval is not allowed', () => {
+    const F = global.Function
+    global.Function = function() { throw new EvalError('Refused to evaluate a string as JavaScript') }
+    try {
+      const lexer = moo.states(spec(), {codegen: true})
+      expect(lexer.states.main.next).toBe(null)
+      expect(lexer.next).toBe(moo.states(spec()).next)
+      lexer.reset('if x')
+      expect(lexAll(lexer).map(t => t.type)).toEqual(['kw', 'space', 'word'])
+    } finally {
+      global.Function = F
+    }
+  })
+
+})
+
+
+describe('dispatch', () => {
+
+  const rules = {
+    keyword: ['while', 'if'],
+    number: /(?:0x[0-9a-f]+|[0-9]+)/u,
+    string: /"(?:\\.|[^"\\])*"/u,
+    name: /\w+/u,
+    space: {match: /\s+/u, lineBreaks: true},
+    sym: /[^\w\s"]/u,
+  }
+
+  test('only tries rules which could start with the character', () => {
+    const lexer = compile(rules, {dispatch: true})
+    expect(lexer.dispatch.length).toBe(128)
+    expect(lexer.dispatch['"'.charCodeAt(0)].regexp.source).not.toContain('\\s')
+    expect(lexer.dispatch['a'.charCodeAt(0)].regexp.source).toContain('\\w')
+    expect(lexer.dispatch['a'.charCodeAt(0)].regexp.source).not.toContain('"')
+  })
+
+  test('lexes the same tokens', () => {
+    const input = 'while (x1 < 0x2f) { if "a\\"b" ☃ }\n'
+    const plain = compile(rules)
+    const lexer = compile(rules, {dispatch: true})
+    expect(lexAll(lexer.reset(input))).toEqual(lexAll(plain.reset(input)))
+  })
+
+  test('uses the full RegExp when unsure', () => {
+    const lexer = compile({
+      odd: /(?:a|b)\1/,
+      word: /[a-z]+/,
+      space: / +/,
+    }, {dispatch: true})
+    expect(lexer.dispatch['c'.charCodeAt(0)]).toBeTruthy()
+    expect(lexer.dispatch['c'.charCodeAt(0)].regexp.source).toContain('\\1')
+  })
+
+  test('is disabled by fallback rules', () => {
+    const lexer = compile({
+      word: /[a-z]+/,
+      text: moo.fallback,
+    }, {dispatch: true})
+    expect(lexer.dispatch).toBe(null)
+  })
+
+})
+
+
+describe('lazy text', () => {
+
+  const rules = {
+    ws: {match: /\s+/, lineBreaks: true},
+    word: {match: /[a-z]+/, type: moo.keywords({kw: ['moo']})},
+    string: {match: /"[^"]*"/, value: x => x.slice(1, -1)},
+  }
+  const input = 'cow "says"\nmoo'
+
+  test('produces the same tokens', () => {
+    const eager = compile(rules).reset(input)
+    const lazy = compile(rules, {lazyText: true}).reset(input)
+    const lazyTokens = lexAll(lazy)
+    expect(lazyTokens.map(t => t.toJSON())).toEqual(lexAll(eager).map(t => ({
+      type: t.type, typeId: t.typeId, value: t.value, text: t.text,
+      offset: t.offset, lineBreaks: t.lineBreaks, line: t.line, col: t.col,
+    })))
+    expect(lazyTokens.map(String)).toEqual(['cow', ' ', 'says', '\n', 'moo'])
+  })
+
+  test('tokens only store a span', () => {
+    const lexer = compile(rules, {lazyText: true}).reset(input)
+    lexer.next()
+    lexer.next()
+    const tok = lexer.next()
+    expect(tok).toMatchObject({type: 'string', offset: 4, length: 6})
+    expect(Object.keys(tok)).not.toContain('text')
+    expect(tok.text).toBe('"says"')
+    expect(tok.value).toBe('says')
+  })
+
+  test('tokens survive reset()', () => {
+    const lexer = compile(rules, {lazyText: true}).reset(input)
+    const tok = lexer.next()
+    lexer.reset('other')
+    expect(tok.text).toBe('cow')
+  })
+
+  test("doesn't leak the buffer into JSON", () => {
+    const lexer = compile(rules, {lazyText: true}).reset(input)
+    expect(JSON.parse(JSON.stringify(lexer.next()))).toEqual({
+      type: 'word', typeId: 1, value: 'cow', text: 'cow',
+      offset: 0, lineBreaks: 0, line: 1, col: 1,
+    })
+  })
+
+  test('still throws errors', () => {
+    const lexer = compile(rules, {lazyText: true}).reset('cow $')
+    expect(() => lexAll(lexer)).toThrow('invalid syntax at line 1 col 5')
+  })
+
+})
+
+
+describe('tokenizeAll', () => {
+
+  const lexer = compile({
+    ws: {match: /\s+/, lineBreaks: true},
+    word: {match: /[a-z]+/, type: moo.keywords({kw: ['moo']})},
+    number: /[0-9]+/,
+    op: ['+', '-'],
+  })
+
+  test('matches the token stream', () => {
+    const input = 'cows 12 + moo\n- 3 moo\nmilk'
+    const tokens = lexAll(lexer.reset(input))
+    const tape = lexer.tokenizeAll(input)
+    expect(tape.length).toBe(tokens.length)
+    for (var i = 0; i < tape.length; i++) {
+      expect(tape.typeNames[tape.types[i]]).toBe(tokens[i].type)
+      expect(tape.offsets[i]).toBe(tokens[i].offset)
+      expect(tape.lengths[i]).toBe(tokens[i].text.length)
+      expect(tape.lines[i]).toBe(tokens[i].line)
+      expect(tape.cols[i]).toBe(tokens[i].col)
+    }
+  })
+
+  test('grows as needed', () => {
+    let input = ''
+    for (var i = 0; i < 1000; i++) input += 'a+'
+    const tape = lexer.tokenizeAll(input)
+    expect(tape.length).toBe(2000)
+    expect(tape.capacity).toBeGreaterThanOrEqual(2000)
+    expect(tape.offsets[1999]).toBe(1999)
+    expect(tape.typeNames).toBe(lexer.types.names)
+  })
+
+  test('has room for lots of types', () => {
+    const lexer = compile({
+      ws: / +/,
+      word: {match: /[a-z0-9]+/, type: t => 'T' + t},
+    })
+    let input = ''
+    for (let i = 0; i < 70000; i++) input += 'x' + i + ' '
+    const tape = lexer.tokenizeAll(input)
+    expect(tape.typeNames[tape.types[tape.length - 2]]).toBe('Tx69999')
+  })
+
+  test('exposes transferable buffers', () => {
+    const tape = lexer.tokenizeAll('moo 1')
+    const buffers = tape.buffers()
+    expect(buffers.length).toBe(5)
+    expect(buffers.every(b => b instanceof ArrayBuffer)).toBe(true)
+    expect(buffers[0]).toBe(tape.types.buffer)
+  })
+
+  test('throws on invalid syntax', () => {
+    expect(() => lexer.tokenizeAll('moo $')).toThrow('invalid syntax at line 1 col 5')
+  })
+
+})
+
+
+describe('parallel', () => {
+
+  const lexer = compile({
+    ws: /[ \t]+/,
+    nl: {match: /\s+/, lineBreaks: true},
+    string: {match: /"(?:\\.|[^"\\\n])*"/, value: s => s.slice(1, -1)},
+    word: {match: /[a-z]+/, type: moo.keywords({kw: ['moo']})},
+    number: /[0-9]+/,
+    op: ['+', '-'],
+  })
+
+  function toArray(tape) {
+    const tokens = []
+    for (var i = 0; i < tape.length; i++) {
+      tokens.push([tape.typeNames[tape.types[i]], tape.offsets[i], tape.lengths[i], tape.lines[i], tape.cols[i]])
+    }
+    return tokens
+  }
+
+  let input = ''
+  for (var i = 0; i < 500; i++) {
+    input += ['cows 12 + moo', '"milk"', '\n\n  \n', '-3', '\n', ' moo'][i * 7 % 6]
+  }
+
+  test('matches tokenizeAll()', async () => {
+    const expected = toArray(lexer.tokenizeAll(input))
+    for (const workers of [1, 2, 5]) {
+      expect(toArray(await moo.parallel(lexer, input, {workers}))).toEqual(expected)
+    }
+  })
+
+  test('reuses its workers', async () => {
+    await moo.parallel.close()
+    const expected = toArray(lexer.tokenizeAll(input))
+    const other = compile({word: /[a-z]+/, space: {match: /\s+/, lineBreaks: true}})
+    expect(toArray(await moo.parallel(lexer, input, {workers: 3}))).toEqual(expected)
+    expect(toArray(await moo.parallel(other, 'ab\ncd\nef', {workers: 3}))).toEqual(toArray(other.tokenizeAll('ab\ncd\nef')))
+    expect(toArray(await moo.parallel(lexer, input, {workers: 3}))).toEqual(expected)
+    expect((await moo.parallel.close()).length).toBe(3)
+    // and starts new ones after close()
+    expect(toArray(await moo.parallel(lexer, input, {workers: 2}))).toEqual(expected)
+  })
+
+  test('matches tokenizeAll() with a fallback rule', async () => {
+    const lexer = compile({
+      kw: ['if'],
+      nl: {match: '\n', lineBreaks: true},
+      text: moo.fallback,
+    })
+    const input = 'abc if def\nif\nxif\n'.repeat(100)
+    expect(toArray(await moo.parallel(lexer, input, {workers: 3}))).toEqual(toArray(lexer.tokenizeAll(input)))
+  })
+
+  test('rejects invalid syntax', async () => {
+    let message
+    await moo.parallel(lexer, input + '$' + input, {workers: 3}).catch(e => message = e.message)
+    expect(message).toMatch('invalid syntax at line ')
+    expect(() => lexer.tokenizeAll(input + '$' + input)).toThrow(message.split('\n')[0])
+  })
+
+  test('rejects tokens which might span lines', async () => {
+    const lexer = compile({
+      comment: {match: /\/\*[^]*?\*\//, lineBreaks: true},
+      op: '/',
+    })
+    let message
+    await moo.parallel(lexer, '/**/', {workers: 2}).catch(e => message = e.message)
+    expect(message).toBe("moo.parallel() can't split the input between lines, since a token might span them (for token 'comment')")
+  })
+
+  test('rejects errorRecovery', async () => {
+    const lexer = compile({word: /[a-z]+/}, {errorRecovery: 'char'})
+    let message
+    await moo.parallel(lexer, 'abc', {workers: 2}).catch(e => message = e.message)
+    expect(message).toBe("moo.parallel() can't collect errors from workers (use errorRecovery: false)")
+  })
+
+  describe('with states', () => {
+
+    const spec = () => ({
+      main: {
+        strstart: {match: '`', push: 'lit'},
+        ident: /\w+/,
+        lbrace: {match: '{', push: 'main'},
+        rbrace: {match: '}', pop: 1},
+        space: {match: /\s+/, lineBreaks: true},
+      },
+      lit: {
+        interp: {match: '${', push: 'main'},
+        strend: {match: '`', pop: 1},
+        nl: {match: '\n', lineBreaks: true},
+        const: /[^$`\n]+/,
+        dollar: '$',
+      },
+    })
+
+    let input = ''
+    for (var i = 0; i < 100; i++) {
+      input += i % 3 ? 'a b\n' : '`x\ny ${ {z} }\n`\n'
+    }
+
+    test('matches tokenizeAll() when guessing wrong', async () => {
+      const lexer = moo.states(spec())
+      const tape = await moo.parallel(lexer, input, {workers: 4})
+      expect(toArray(tape)).toEqual(toArray(lexer.tokenizeAll(input)))
+      expect(tape.chunks).toBe(4)
+      expect(tape.relexed).toBeGreaterThan(0)
+    })
+
+    test('counts chunks lexed again', async () => {
+      const lexer = moo.states(spec())
+      const guess = (input, offset) => {
+        const lexer = moo.states(spec()).reset(input.slice(0, offset))
+        while (lexer.next()) {}
+        return lexer.state
+      }
+      const tape = await moo.parallel(lexer, input, {workers: 4, guess})
+      expect(toArray(tape)).toEqual(toArray(lexer.tokenizeAll(input)))
+      expect(tape.relexed).toBe(0)
+    })
+
+    test('rejects guesses of missing states', async () => {
+      let message
+      await moo.parallel(moo.states(spec()), input, {workers: 2, guess: () => 'nope'}).catch(e => message = e.message)
+      expect(message).toBe("moo.parallel() guessed a missing state 'nope'")
+    })
+
+  })
+
+})
+
+
+describe('streaming', () => {
+
+  function feedAll(lexer, chunks) {
+    lexer.reset()
+    const tokens = []
+    for (const chunk of chunks) {
+      tokens.push(...lexer.feed(chunk))
+    }
+    tokens.push(...lexer.end())
+    return tokens
+  }
+
+  function checkSplits(lexer, input) {
+    const expected = lexAll(lexer.reset(input))
+    for (var i = 0; i <= input.length; i++) {
+      expect(feedAll(lexer, [input.slice(0, i), input.slice(i)])).toEqual(expected)
+    }
+    expect(feedAll(lexer, input.split(''))).toEqual(expected)
+  }
+
+  test('handles tokens split across chunks', () => {
+    checkSplits(require('./json'), '{"moo": [1.5, -20e3, true], "baa": null}')
+  })
+
+  test('works with states', () => {
+    const lexer = moo.states({
+      main: {
+        strstart: {match: '`', push: 'lit'},
+        ident:    /\w+/,
+        lbrace:   {match: '{', push: 'main'},
+        rbrace:   {match: '}', pop: true},
+        colon:    ':',
+        space:    {match: /\s+/, lineBreaks: true},
+      },
+      lit: {
+        interp:   {match: '${', push: 'main'},
+        escape:   /\\./,
+        strend:   {match: '`', pop: true},
+        const:    {match: /(?:[^$`]|\$(?!\{))+/, lineBreaks: true},
+      },
+    })
+    checkSplits(lexer, '`a${{c: d}}e` {f: `g\nh`}')
+  })
+
+  test('works with fallback tokens', () => {
+    const lexer = compile({
+      op: /[._]/,
+      text: moo.fallback,
+    })
+    checkSplits(lexer, '.this_th\nat.foo..bar')
+  })
+
+  test('reports absolute offsets and lines', () => {
+    const lexer = compile({
+      word: /[a-z]+/,
+      nl: {match: '\n', lineBreaks: true},
+    })
+    const tokens = feedAll(lexer, ['moo\nba', 'a\nm', 'oo'])
+    expect(tokens.map(t => [t.value, t.offset, t.line, t.col])).toEqual([
+      ['moo', 0, 1, 1],
+      ['\n', 3, 1, 4],
+      ['baa', 4, 2, 1],
+      ['\n', 7, 2, 4],
+      ['moo', 8, 3, 1],
+    ])
+  })
+
+  test('only keeps incomplete tokens in the buffer', () => {
+    const lexer = compile({
+      word: /[a-z]+/,
+      space: / +/,
+      nl: {match: '\n', lineBreaks: true},
+    })
+    lexer.reset()
+    for (var i = 0; i < 100; i++) {
+      lexer.feed('moo baa\n')
+    }
+    expect(lexer.buffer.length).toBeLessThan(16)
+    expect(lexer.end().map(t => t.value)).toEqual(['\n'])
+  })
+
+  test('waits for the end of the line', () => {
+    const lexer = compile({
+      str: /"[^"]*"/,
+      quote: '"',
+      word: /[a-z]+/,
+      space: / +/,
+      nl: {match: '\n', lineBreaks: true},
+    })
+    lexer.reset()
+    expect(lexer.feed('"ab cd')).toEqual([])
+    expect(lexer.feed(' ef" x')).toEqual([])
+    expect(lexer.end().map(t => t.type)).toEqual(['str', 'space', 'word'])
+    checkSplits(lexer, '"ab cd ef" x "\ny')
+  })
+
+  test('works with comments and catch-all rules', () => {
+    checkSplits(compile({
+      ws: {match: /\s+/, lineBreaks: true},
+      comment: /\/\/.*/,
+      str: /"(?:\\.|[^"\\\n])*"/,
+      word: /[a-z]+/,
+      other: /./,
+    }), 'foo "bar // baz" // "qux\n  "quux\n// end " x\n')
+  })
+
+  test('holds everything back if a token might span lines', () => {
+    const lexer = compile({
+      ws: {match: /\s+/, lineBreaks: true},
+      comment: {match: /\/\*[^]*?\*\//, lineBreaks: true},
+      word: /[a-z]+/,
+      op: ['/', '*'],
+    })
+    lexer.reset()
+    expect(lexer.feed('a /* b\n')).toEqual([])
+    expect(lexer.feed('c */ d\n')).toEqual([])
+    expect(lexer.end().map(t => t.type)).toEqual(['word', 'ws', 'comment', 'ws', 'word', 'ws'])
+    checkSplits(lexer, 'a /* b\nc */ d / e\n')
+  })
+
+  test('works with lazy text', () => {
+    const lexer = compile({word: /[a-z]+/, space: / +/}, {lazyText: true})
+    expect(feedAll(lexer, ['moo b', 'aa', ' cow']).map(t => t.text)).toEqual(['moo', ' ', 'baa', ' ', 'cow'])
+  })
+
+  test('only throws errors at the end', () => {
+    const lexer = compile({word: /[a-z]+/})
+    lexer.reset()
+    expect(lexer.feed('moo!').map(t => t.value)).toEqual([])
+    expect(() => lexer.end()).toThrow('invalid syntax at line 1 col 4')
+  })
+
+})
+
+
+describe('incremental lexing', () => {
+
+  const lexer = moo.states({
+    main: {
+      strstart: {match: '`', push: 'lit'},
+      ident:    /\w+/,
+      lbrace:   {match: '{', push: 'main'},
+      rbrace:   {match: '}', pop: true},
+      colon:    ':',
+      space:    {match: /\s+/, lineBreaks: true},
+      error:    moo.error,
+    },
+    lit: {
+      interp:   {match: '${', push: 'main'},
+      strend:   {match: '`', pop: true},
+      const:    {match: /(?:[^$`]|\$(?!\{))+/, lineBreaks: true},
+    },
+  })
+
+  function summary(tokens) {
+    return tokens.map(t => [t.type, t.text, t.offset, t.line, t.col])
+  }
+
+  function check(doc) {
+    expect(summary(doc.tokens)).toEqual(summary(lexAll(lexer.reset(doc.text))))
+  }
+
+  test('lexes the initial text', () => {
+    const doc = lexer.incremental('`a${b}c`')
+    expect(doc.tokens.map(t => t.type).join(' ')).toBe('strstart const interp ident rbrace const strend')
+    check(doc)
+  })
+
+  test('copes with big documents', () => {
+    const doc = lexer.incremental('ab '.repeat(110000), 1)
+    expect(doc.tokens.length).toBe(220000)
+    expect(doc.checkpoints.length).toBeGreaterThan(200000)
+    // paste a big block in the middle
+    const patch = doc.edit(3, 0, 'cd '.repeat(110000))
+    expect(patch.tokens.length).toBeGreaterThanOrEqual(220000)
+    expect(doc.tokens.length).toBe(440000)
+    expect(doc.tokens[439999]).toMatchObject({offset: 659999, col: 660000})
+    expect(summary(doc.tokens)).toEqual(summary(lexer.incremental(doc.text).tokens))
+  })
+
+  test('only re-lexes around the edit', () => {
+    const doc = lexer.incremental('{a: b}\n'.repeat(100), 4)
+    const patch = doc.edit(7 * 50 + 4, 1, 'cow')
+    expect(doc.text.slice(7 * 50 - 1, 7 * 50 + 11)).toBe('\n{a: cow}\n{a')
+    expect(patch.tokens.length).toBeLessThan(20)
+    expect(patch.index).toBeGreaterThan(200)
+    check(doc)
+  })
+
+  test('returns a splice', () => {
+    const doc = lexer.incremental('foo bar baz')
+    const before = doc.tokens.slice()
+    const patch = doc.edit(4, 3, 'moo\ncow')
+    before.splice(patch.index, patch.removed, ...patch.tokens)
+    expect(before).toEqual(doc.tokens)
+    check(doc)
+  })
+
+  test('follows state changes', () => {
+    const doc = lexer.incremental('a b c `d e f` g h i', 2)
+    doc.edit(2, 0, '`')
+    check(doc)
+    expect(doc.tokens[doc.tokens.length - 1]).toMatchObject({type: 'const', text: ' g h i'})
+    doc.edit(2, 1, '')
+    check(doc)
+  })
+
+  test('handles many edits', () => {
+    const doc = lexer.incremental('`a${{c: d}}e` x {a: `b c\nd`}\n'.repeat(10), 3)
+    const edits = [[0, 0, '{'], [5, 2, ''], [40, 0, '`'], [12, 1, '\n\n'], [0, 1, ''], [100, 10, 'moo'], [60, 0, '}']]
+    for (const [offset, length, text] of edits) {
+      doc.edit(offset, length, text)
+      check(doc)
+    }
+  })
+
+  test('notices when an edit closes a string further back', () => {
+    const strings = compile({
+      str: /"[^"\n]*"/,
+      quote: '"',
+      word: /[a-z]+/,
+      space: / +/,
+      nl: {match: '\n', lineBreaks: true},
+    })
+    const doc = strings.incremental('x\n"ab cd ef gh', 2)
+    doc.edit(doc.text.length, 0, '"')
+    expect(doc.tokens.map(t => t.type)).toEqual(['word', 'nl', 'str'])
+    expect(summary(doc.tokens)).toEqual(summary(lexAll(strings.reset(doc.text))))
+  })
+
+  test('notices when an edit closes a block comment', () => {
+    const comments = compile({
+      ws: {match: /\s+/, lineBreaks: true},
+      comment: {match: /\/\*[^]*?\*\//, lineBreaks: true},
+      word: /[a-z]+/,
+      op: ['/', '*'],
+    })
+    const doc = comments.incremental('/* a b c d e f g h i j k', 4)
+    doc.edit(doc.text.length, 0, ' */')
+    expect(doc.tokens.map(t => t.type)).toEqual(['comment'])
+    doc.edit(0, 1, '')
+    expect(doc.tokens.length).toBe(26)
+    doc.edit(0, 0, 'x\n/')
+    doc.edit(doc.text.length, 0, '\ny /* z\n*/')
+    expect(doc.tokens.map(t => t.type)).toEqual(['word', 'ws', 'comment', 'ws', 'word', 'ws', 'comment'])
+    expect(summary(doc.tokens)).toEqual(summary(lexAll(comments.reset(doc.text))))
+  })
+
+  test('notices a skipped block comment', () => {
+    const comments = compile({
+      ws: {match: /\s+/, lineBreaks: true, skip: true},
+      comment: {match: /\/\*[^]*?\*\//, lineBreaks: true, skip: true},
+      word: /[a-z]+/,
+      op: ['/', '*'],
+    })
+    const doc = comments.incremental('  /* a\nb c */ d', 2)
+    expect(doc.tokens.map(t => t.text)).toEqual(['d'])
+    doc.edit(5, 0, '*/')
+    expect(doc.tokens.map(t => t.text)).toEqual(['a', 'b', 'c', '*', '/', 'd'])
+    doc.edit(0, 3, '')
+    expect(summary(doc.tokens)).toEqual(summary(lexAll(comments.reset(doc.text))))
+  })
+
+  test('checks edits are inside the text', () => {
+    const doc = lexer.incremental('moo')
+    expect(() => doc.edit(2, 2, '')).toThrow('Edit is outside the text')
+  })
+
+})
+
+
+describe('Lexer#has', () => {
+
+  const basicLexer = compile({
+    keyword: 'foo',
+    identifier: /[a-z]+/,
+    error: moo.error
+  })
+
+  test('supports has()', () => {
+    expect(basicLexer.has('identifier')).toBe(true)
+  })
+
+  test('works with literals', () => {
+    expect(basicLexer.has('keyword')).toBe(true)
+  })
+
+  test('finds the error token', () => {
+    expect(basicLexer.has('error')).toBe(true)
+  })
+
+  test('returns false for nonexistent junk', () => {
+    expect(basicLexer.has('random')).toBe(false)
+  })
+
+  const keywordLexer = compile({
+    identifier: {
+      match: /[a-zA-Z]+/,
+      type: moo.keywords({
+        'kw-class': 'class',
+        'kw-def': 'def',
+        'kw-if': 'if',
+      }),
+    },
+  })
+
+  test("works with keywords", () => {
+    expect(keywordLexer.has('kw-class')).toBe(true)
+    expect(keywordLexer.has('kw-moo')).toBe(false)
+  })
+
+  test("returns true for anything with other type transforms", () => {
+    const lexer = compile({
+      identifier: {match: /[a-z]+/, type: x => 'word-' + x},
+    })
+    expect(lexer.has('word-moo')).toBe(true)
+  })
+
+  test("doesn't include the default error token", () => {
+    expect(compile({word: /[a-z]+/}).has('error')).toBe(false)
+  })
+
+  // Example from the readme.
+  const statefulLexer = moo.states({
+    main: {
+      strstart: {match: '`', push: 'lit'},
+      ident:    /\w+/,
+      lbrace:   {match: '{', push: 'main'},
+      rbrace:   {match: '}', pop: true},
+      colon:    ':',
+      space:    {match: /\s+/, lineBreaks: true},
+      mainErr:  moo.error,
+    },
+    lit: {
+      interp:   {match: '${', push: 'main'},
+      escape:   /\\./,
+      strend:   {match: '`', pop: true},
+      const:    {match: /(?:[^$`]|\$(?!\{))+/, lineBreaks: true},
+			litErr:   moo.error,
+    },
+  })
+
+  test('works with multiple states - for first state', () => {
+    expect(statefulLexer.has('ident')).toEqual(true)
+  })
+
+  test('works with multiple states - for second state', () => {
+    expect(statefulLexer.has('interp')).toEqual(true)
+  })
+
+  test('works with error tokens - for first state', () => {
+    expect(statefulLexer.has('mainErr')).toEqual(true)
+  })
+
+  test('works with error tokens - for second state', () => {
+    expect(statefulLexer.has('litErr')).toEqual(true)
+  })
+
+  test('returns false for nonexistent junk - with multiple states', () => {
+    expect(statefulLexer.has('lit')).toEqual(false)
+  })
+
+})
+
+
+describe('type ids', () => {
+
+  const lexer = moo.states({
+    main: {
+      strstart: {match: '`', push: 'lit'},
+      ident: {match: /\w+/, type: moo.keywords({kw: ['if', 'else']})},
+      space: {match: /\s+/, lineBreaks: true},
+    },
+    lit: {
+      strend: {match: '`', pop: true},
+      const: {match: /[^`]+/, lineBreaks: true},
+    },
+  })
+
+  test('are dense', () => {
+    const names = lexer.types.names
+    expect(names.slice().sort()).toEqual(['const', 'ident', 'kw', 'space', 'strend', 'strstart'])
+    for (var i = 0; i < names.length; i++) {
+      expect(lexer.types.ids[names[i]]).toBe(i)
+    }
+  })
+
+  test('are carried by tokens', () => {
+    lexer.reset('if `x` y')
+    for (const tok of lexer) {
+      expect(lexer.types.names[tok.typeId]).toBe(tok.type)
+    }
+  })
+
+  test("aren't assigned to unknown types", () => {
+    const lexer = compile({
+      word: {match: /[a-z]+/, type: x => x === 'moo' ? 'word' : 'word-' + x},
+      space: / +/,
+    })
+    const names = lexer.types.names.slice()
+    lexer.reset('moo baa moo')
+    const tokens = lexAll(lexer)
+    expect(tokens.map(t => t.typeId)).toEqual([lexer.types.ids.word, lexer.types.ids.space, -1, lexer.types.ids.space, lexer.types.ids.word])
+    expect(lexer.types.names).toEqual(names)
+  })
+
+  test('are assigned to unknown types by tapes', () => {
+    const lexer = compile({
+      word: {match: /[a-z]+/, type: x => 'word-' + x},
+      space: / +/,
+    })
+    const names = lexer.types.names.slice()
+    const tape = lexer.tokenizeAll('moo baa moo')
+    const types = Array.from(tape.types.subarray(0, tape.length))
+    expect(types.map(id => tape.typeNames[id])).toEqual(['word-moo', 'space', 'word-baa', 'space', 'word-moo'])
+    expect(types[0]).toBe(types[4])
+    expect(lexer.types.names).toEqual(names)
+  })
+
+  test('are shared with clones', () => {
+    expect(lexer.clone().types).toBe(lexer.types)
+  })
+
+})
+
+
+describe('stateful lexer', () => {
+
+  const statefulLexer = moo.states({
+    start: {
+      word: /\w+/,
+      eq: {match: '=', next: 'ab'},
+      myError: moo.error,
+    },
+    ab: {
+      a: 'a',
+      b: 'b',
+      semi: {match: ';', next: 'start'},
+    },
+  })
+
+  test('switches states', () => {
+    statefulLexer.reset('one=ab;two=')
+    expect(lexAll(statefulLexer).map(({type, value}) => [type, value])).toEqual([
+      ['word', 'one'],
+      ['eq', '='],
+      ['a', 'a'],
+      ['b', 'b'],
+      ['semi', ';'],
+      ['word', 'two'],
+      ['eq', '='],
+    ])
+  })
+
+  test('supports errors', () => {
+    statefulLexer.reset('foo!')
+    expect(lexAll(statefulLexer).map(({type, value}) => [type, value])).toEqual([
+      ['word', 'foo'],
+      ['myError', '!'],
+    ])
+  })
+
+  const parens = moo.states({
+    start: {
+      word: /\w+/,
+      lpar: {match: '(', push: 'inner'},
+      rpar: ')',
+    },
+    inner: {
+      thing: /\w+/,
+      lpar: {match: '(', push: 'inner'},
+      rpar: {match: ')', pop: true},
+    },
+  })
+
+  test('maintains a stack', () => {
+    parens.reset('a(b(c)d)e')
+    expect(lexAll(parens).map(({type, value}) => [type, value])).toEqual([
+      ['word', 'a'],
+      ['lpar', '('],
+      ['thing', 'b'],
+      ['lpar', '('],
+      ['thing', 'c'],
+      ['rpar', ')'],
+      ['thing', 'd'],
+      ['rpar', ')'],
+      ['word', 'e'],
+    ])
+  })
+
+  test('allows popping too many times', () => {
+    parens.reset(')e')
+    expect(lexAll(parens).map(({type, value}) => [type, value])).toEqual([
+      ['rpar', ')'],
+      ['word', 'e'],
+    ])
+  })
+
+  test('resets state', () => {
+    statefulLexer.reset('one=a')
+    expect(statefulLexer.state).toBe('start')
+    expect(lexAll(statefulLexer).map(({type, value}) => [type, value])).toEqual([
+      ['word', 'one'],
+      ['eq', '='],
+      ['a', 'a'],
+    ])
+    expect(statefulLexer.state).toBe('ab')
+    statefulLexer.reset('one=ab;two=')
+    expect(statefulLexer.state).toBe('start')
+  })
+
+  test('lexes interpolation example', () => {
+    let lexer = moo.states({
+      main: {
+        strstart: {match: '`', push: 'lit'},
+        ident:    /\w+/,
+        lbrace:   {match: '{', push: 'main'},
+        rbrace:   {match: '}', pop: true},
+        colon:    ':',
+        space:    {match: /\s+/, lineBreaks: true},
+      },
+      lit: {
+        interp:   {match: '${', push: 'main'},
+        escape:   /\\./,
+        strend:   {match: '`', pop: true},
+        const:    {match: /(?:[^$`]|\$(?!\{))+/, lineBreaks: true},
+      },
+    }).reset('`a${{c: d}}e`')
+    expect(lexAll(lexer).map(t => t.type).join(' ')).toBe('strstart const interp lbrace ident colon space ident rbrace rbrace const strend')
+  })
+
+  test('warns for non-existent states', () => {
+    expect(() => moo.states({start: {bar: {match: 'bar', next: 'foo'}}})).toThrow("Missing state 'foo'")
+    expect(() => moo.states({start: {bar: {match: 'bar', push: 'foo'}}})).toThrow("Missing state 'foo'")
+    expect(() => moo.states({start: {foo: 'fish', bar: {match: 'bar', push: 'foo'}}})).toThrow("Missing state 'foo'")
+  })
+
+  test('warns for non-boolean pop', () => {
+    expect(() => moo.states({start: {bar: {match: 'bar', pop: 'cow'}}})).toThrow("pop must be 1 (in token 'bar' of state 'start')")
+    expect(() => moo.states({start: {bar: {match: 'bar', pop: 2}}})).toThrow("pop must be 1 (in token 'bar' of state 'start')")
+    expect(() => moo.states({start: {bar: {match: 'bar', pop: true}}})).not.toThrow()
+    expect(() => moo.states({start: {bar: {match: 'bar', pop: 1}}})).not.toThrow()
+    expect(() => moo.states({start: {bar: {match: 'bar', pop: false}}})).not.toThrow()
+    expect(() => moo.states({start: {bar: {match: 'bar', pop: 0}}})).not.toThrow()
+  })
+
+})
+
+
+describe('line numbers', () => {
+
+  var testLexer = compile({
+    WS: / +/,
+    word: /[a-z]+/,
+    NL: { match: /\n/, lineBreaks: true },
+  })
+
+  test('counts line numbers', () => {
+    var tokens = lexAll(testLexer.reset('cow\nfarm\ngrass'))
+    expect(tokens.map(t => t.value)).toEqual(['cow', '\n', 'farm', '\n', 'grass'])
+    expect(tokens.map(t => t.lineBreaks)).toEqual([0, 1, 0, 1, 0])
+    expect(tokens.map(t => t.line)).toEqual([1, 1, 2, 2, 3])
+    expect(tokens.map(t => t.col)).toEqual([1, 4, 1, 5, 1])
+  })
+
+  test('needs lineBreaks for a newline literal', () => {
+    expect(() => compile({
+      WS: / +/,
+      NL: '\n',
+      word: /[a-z]+/,
+    })).toThrow('Rule should declare lineBreaks')
+    const lexer = compile({
+      WS: / +/,
+      NL: {match: '\n', lineBreaks: true},
+      word: /[a-z]+/,
+    })
+    expect(lexAll(lexer.reset('a\nb\nc')).map(t => t.line)).toEqual([1, 1, 2, 2, 3])
+  })
+
+  test('tracks columns', () => {
+    var lexer = compile({
+      WS: / +/,
+      thing: { match: /[a-z\n]+/, lineBreaks: true },
+    })
+    lexer.reset('pie cheese\nsalad what\n ')
+    expect(lexer.next()).toMatchObject({ value: 'pie', col: 1 })
+    expect(lexer.next()).toMatchObject({ value: ' ', col: 4 })
+    expect(lexer.next()).toMatchObject({ value: 'cheese\nsalad', col: 5, line: 1 })
+    expect(lexer.next()).toMatchObject({ value: ' ', col: 6, line: 2 })
+    expect(lexer.next()).toMatchObject({ value: 'what\n', col: 7, line: 2 })
+    expect(lexer.next()).toMatchObject({ value: ' ', col: 1, line: 3 })
+  })
+
+  test('tries to warn if rule matches \\n', () => {
+    expect(() => compile({whitespace: /\s+/})).toThrow()
+    expect(() => compile({multiline: /q[^]*/})).not.toThrow()
+  })
+
+  test('resets line/col', () => {
+    var lexer = compile({
+      WS: / +/,
+      word: /[a-z]+/,
+      NL: { match: '\n', lineBreaks: true },
+    })
+    lexer.reset('potatoes\nsalad')
+    expect(lexer).toMatchObject({buffer: 'potatoes\nsalad', line: 1, col: 1})
+    lexAll(lexer)
+    expect(lexer).toMatchObject({line: 2, col: 6})
+    lexer.reset('cheesecake')
+    expect(lexer).toMatchObject({buffer: 'cheesecake', line: 1, col: 1})
+  })
+
+})
+
+
+describe('save/restore', () => {
+
+  const testLexer = compile({
+    word: /[a-z]+/,
+    NL: { match: '\n', lineBreaks: true },
+  })
+
+  test('can save info', () => {
+    testLexer.reset('one\ntwo')
+    lexAll(testLexer)
+    expect(testLexer.save()).toMatchObject({line: 2, col: 4})
   })
 
   test('can restore info', () => {
@@ -877,16 +2294,58 @@ describe('save/restore', () => {
     statefulLexer.reset('one=a;')
     statefulLexer.next() // one
     statefulLexer.next() // =
-    expect(statefulLexer.save()).toMatchObject({stack: ['start']})
+    expect(statefulLexer.save().stack.toArray()).toEqual(['start'])
     statefulLexer.next() // a
     statefulLexer.next() // ;
-    expect(statefulLexer.save()).toMatchObject({stack: ['start', 'ab']})
+    expect(statefulLexer.save().stack.toArray()).toEqual(['start', 'ab'])
   })
 
   test('can restore stack', () => {
     statefulLexer.reset('one=a;', { stack: ['one', 'two'], state: 'ab' })
     expect(statefulLexer.state).toBe('ab')
-    expect(statefulLexer.stack).toEqual(['one', 'two'])
+    expect(statefulLexer.stack.toArray()).toEqual(['one', 'two'])
+  })
+
+  test("doesn't copy the stack", () => {
+    statefulLexer.reset('one=a;')
+    statefulLexer.next() // one
+    statefulLexer.next() // =
+    const info = statefulLexer.save()
+    expect(statefulLexer.save().stack).toBe(info.stack)
+    statefulLexer.next() // a
+    statefulLexer.next() // ;
+    expect(info.stack.toArray()).toEqual(['start'])
+  })
+
+  test('can rewind with restore()', () => {
+    statefulLexer.reset('one=a;two')
+    statefulLexer.next() // one
+    statefulLexer.next() // =
+    const info = statefulLexer.save()
+    const rest = lexAll(statefulLexer).map(t => t.value)
+    expect(statefulLexer.restore(info)).toBe(statefulLexer)
+    expect(statefulLexer.state).toBe('ab')
+    expect(statefulLexer.stack.toArray()).toEqual(['start'])
+    expect(lexAll(statefulLexer).map(t => t.value)).toEqual(rest)
+    statefulLexer.restore(info)
+    expect(statefulLexer.next()).toMatchObject({value: 'a', offset: 4, line: 1, col: 5})
+  })
+
+  test('can restore after peeking', () => {
+    statefulLexer.reset('one=a;')
+    statefulLexer.next() // one
+    const info = statefulLexer.save()
+    statefulLexer.peek(3)
+    statefulLexer.restore(info)
+    expect(lexAll(statefulLexer).map(t => t.value)).toEqual(['=', 'a', ';'])
+  })
+
+  test("won't restore outside the buffer", () => {
+    statefulLexer.reset('one=a;')
+    statefulLexer.next()
+    const info = statefulLexer.save()
+    statefulLexer.reset('x')
+    expect(() => statefulLexer.restore(info)).toThrow("not in the buffer")
   })
 
 })
@@ -967,6 +2426,49 @@ describe('errors', () => {
     )
   })
 
+  test('only show the lines around the token', () => {
+    let lexer = compile({
+      ws: {match: /\s/, lineBreaks: true},
+      word: /[a-z]+/,
+    }, {errorRecovery: 'resync'})
+    const lines = []
+    for (let i = 1; i <= 20; i++) lines.push(i === 10 ? 'ab $ cd' : 'line')
+    lexer.reset(lines.join('\n'))
+    lexAll(lexer)
+    const errors = lexer.errors
+    expect(errors).toEqual([{text: '$', offset: 48, line: 10, col: 4}])
+    const expected =
+      "oops at line 10 col 4:\n\n" +
+      " 8  line\n" +
+      " 9  line\n" +
+      "10  ab $ cd\n" +
+      "       ^\n" +
+      "11  line\n" +
+      "12  line"
+    expect(lexer.formatError(errors[0], "oops")).toBe(expected)
+    // (even if the lexer hasn't got that far)
+    lexer.reset(lexer.buffer)
+    lexer.next()
+    expect(lexer.formatError(errors[0], "oops")).toBe(expected)
+  })
+
+  test('only show the lines left in the buffer', () => {
+    let lexer = compile({
+      ws: {match: /\s/, lineBreaks: true},
+      word: /[a-z]+/,
+    })
+    lexer.reset()
+    lexer.feed('one\ntwo\nthree\n')
+    const tokens = lexer.feed('four five\n')
+    expect(lexer.formatError(tokens[tokens.length - 1], "oops")).toBe(
+      "oops at line 4 col 6:\n\n" +
+      "3  \n" +
+      "4  four five\n" +
+      "        ^\n" +
+      "5  "
+    )
+  })
+
 
   test('seek to end of buffer when thrown', () => {
     let lexer = compile({
@@ -1036,6 +2538,115 @@ describe('errors', () => {
 })
 
 
+describe('error recovery', () => {
+
+  const rules = {
+    word: /[a-z]+/,
+    space: / +/,
+    nl: {match: '\n', lineBreaks: true},
+    arrow: '=>',
+  }
+
+  test('skips one character at a time', () => {
+    const lexer = compile(rules, {errorRecovery: 'char'})
+    lexer.reset('ab ?!cd\n=x')
+    expect(lexAll(lexer).map(t => t.value)).toEqual(['ab', ' ', 'cd', '\n', 'x'])
+    expect(lexer.errors).toEqual([
+      {text: '?', offset: 3, line: 1, col: 4},
+      {text: '!', offset: 4, line: 1, col: 5},
+      {text: '=', offset: 8, line: 2, col: 1},
+    ])
+  })
+
+  test('can skip to where a rule matches', () => {
+    const lexer = compile(rules, {errorRecovery: 'resync'})
+    lexer.reset('ab ?!=cd\n12=>x')
+    expect(lexAll(lexer).map(t => t.value)).toEqual(['ab', ' ', 'cd', '\n', '=>', 'x'])
+    expect(lexer.errors).toEqual([
+      {text: '?!=', offset: 3, line: 1, col: 4},
+      {text: '12', offset: 9, line: 2, col: 1},
+    ])
+  })
+
+  test('keeps counting lines', () => {
+    const lexer = compile({word: /[a-z]+/}, {errorRecovery: 'resync'})
+    lexer.reset('ab\n\ncd')
+    expect(lexAll(lexer)).toMatchObject([{value: 'ab', line: 1}, {value: 'cd', line: 3, col: 1}])
+    expect(lexer.errors).toEqual([{text: '\n\n', offset: 2, line: 1, col: 3}])
+  })
+
+  test("doesn't split surrogate pairs", () => {
+    const lexer = compile({word: /[a-z]+/}, {errorRecovery: 'char'})
+    lexer.reset('a🐮b')
+    expect(lexAll(lexer).map(t => t.value)).toEqual(['a', 'b'])
+    expect(lexer.errors).toMatchObject([{text: '🐮'}])
+  })
+
+  test('replaces error tokens', () => {
+    const lexer = compile({word: /[a-z]+/, error: moo.error}, {errorRecovery: 'char'})
+    lexer.reset('a1b')
+    expect(lexAll(lexer).map(t => t.type)).toEqual(['word', 'word'])
+    expect(lexer.errors).toHaveLength(1)
+  })
+
+  test("doesn't affect fallback tokens", () => {
+    const lexer = compile({word: /[a-z]+/, other: moo.fallback}, {errorRecovery: 'char'})
+    lexer.reset('a12b')
+    expect(lexAll(lexer).map(t => t.value)).toEqual(['a', '12', 'b'])
+    expect(lexer.errors).toEqual([])
+  })
+
+  test('works with every way of lexing', () => {
+    const input = 'ab ?!cd\n12=>x =\n'
+    const expected = compile(rules, {errorRecovery: 'resync'})
+    expected.reset(input)
+    const values = lexAll(expected).map(t => t.value)
+
+    for (const options of [{codegen: true}, {lazyText: true}, {positionTracking: 'offset'}, {dispatch: true}]) {
+      options.errorRecovery = 'resync'
+      const lexer = compile(rules, options)
+      lexer.reset(input)
+      expect(lexAll(lexer).map(t => t.value)).toEqual(values)
+      expect(lexer.errors.map(e => e.offset)).toEqual(expected.errors.map(e => e.offset))
+    }
+
+    const lexer = compile(rules, {errorRecovery: 'resync'})
+    const tape = lexer.tokenizeAll(input)
+    expect(tape.length).toBe(values.length)
+    expect(lexer.errors).toEqual(expected.errors)
+
+    lexer.reset()
+    const tokens = []
+    for (let i = 0; i < input.length; i += 3) {
+      tokens.push(...lexer.feed(input.slice(i, i + 3)))
+    }
+    tokens.push(...lexer.end())
+    expect(tokens.map(t => t.value)).toEqual(values)
+    expect(lexer.errors).toEqual(expected.errors)
+  })
+
+  test('forgets errors after restore()', () => {
+    const lexer = compile(rules, {errorRecovery: 'char'})
+    lexer.reset('ab ? cd ?')
+    lexer.next()
+    const info = lexer.save()
+    lexAll(lexer)
+    expect(lexer.errors).toHaveLength(2)
+    lexer.restore(info)
+    expect(lexer.errors).toHaveLength(0)
+    lexAll(lexer)
+    expect(lexer.errors).toHaveLength(2)
+    lexer.reset('ab')
+    expect(lexer.errors).toEqual([])
+  })
+
+  test('rejects unknown modes', () => {
+    expect(() => compile(rules, {errorRecovery: 'skip'})).toThrow("errorRecovery must be false, 'char' or 'resync' (not 'skip')")
+  })
+
+})
+
+
 describe('example: python', () => {
 
   const pythonLexer = require('./python').lexer